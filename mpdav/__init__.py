@@ -16,5 +16,14 @@
 # along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
 
 from headers_dict import HeadersDict
-from request import WebDavRequestHandler
+from request import ChunkedReader, WebDavRequestHandler
+from checksums import ChecksumStore
+from compression import Compressor
+from content_cache import ContentCache
+from dead_properties import PropertyStore
 from file_backend import FileBackend
+from journal import ChangeJournal
+from locks import LockManager
+from metadata_cache import MetadataCache
+from response_cache import ResponseCache
+from wsgi_app import DavWsgiApp
@@ -0,0 +1,199 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import headers_dict
+import stat
+import struct
+import tarfile
+import time
+import zlib
+
+TAR = "application/x-tar"
+ZIP = "application/zip"
+MEDIA_TYPES = (TAR, ZIP)
+NAMES = {"tar": TAR, "zip": ZIP}
+
+ZIP_LIMIT = 0xffffffff  # sizes and offsets without ZIP64 extensions
+ZIP_MAX_ENTRIES = 0xffff
+ZIP_FLAGS = 0x0808  # data descriptor follows the data, UTF-8 names
+ZIP_VERSION = 20
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_DATA_DESCRIPTOR = struct.Struct("<IIII")
+ZIP_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP_END = struct.Struct("<IHHHHIIH")
+
+
+def negotiate(accept):
+    # the archive media type asked for in Accept or None, only explicit
+    # ones count, not */* of browsers
+    qualities = headers_dict.qualities(accept)
+
+    best = None
+    best_quality = 0.0
+
+    for media_type in MEDIA_TYPES:
+        quality = qualities.get(media_type, 0.0)
+        if quality > best_quality:
+            best = media_type
+            best_quality = quality
+
+    return best
+
+
+def _read(filename, size, block_size):
+    # exactly size bytes of filename, the header is already out, so a file
+    # that shrank (or vanished) meanwhile is padded with zeros
+    remaining = size
+
+    try:
+        with open(filename, "rb") as f:
+            while remaining > 0:
+                buf = f.read(min(remaining, block_size))
+                if not buf:
+                    break
+
+                remaining -= len(buf)
+                yield buf
+    except IOError:
+        pass
+
+    while remaining > 0:
+        n = min(remaining, block_size)
+        remaining -= n
+        yield "\0" * n
+
+
+class TarArchive(object):
+    # pax tar archive of entries, (name, filename, stat result) tuples with
+    # UTF-8 names, directories end with a slash. Generated while it is
+    # sent, with a fixed length known in advance.
+
+    content_type = TAR
+    extension = ".tar"
+
+    def __init__(self, entries, block_size):
+        self.entries = entries
+        self.block_size = block_size
+
+    def _header(self, name, st):
+        info = tarfile.TarInfo(name.rstrip("/"))
+        info.mtime = int(st.st_mtime)
+        info.mode = stat.S_IMODE(st.st_mode)
+
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = st.st_size
+
+        return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "strict")
+
+    def _size(self, st):
+        return 0 if stat.S_ISDIR(st.st_mode) else st.st_size
+
+    def content_length(self):
+        length = 2 * tarfile.BLOCKSIZE  # end of archive
+
+        for name, _, st in self.entries:
+            size = self._size(st)
+            length += len(self._header(name, st)) + size + (-size % tarfile.BLOCKSIZE)
+
+        return length
+
+    def __iter__(self):
+        for name, filename, st in self.entries:
+            yield self._header(name, st)
+
+            size = self._size(st)
+            if size:
+                for buf in _read(filename, size, self.block_size):
+                    yield buf
+
+                if size % tarfile.BLOCKSIZE:
+                    yield "\0" * (-size % tarfile.BLOCKSIZE)
+
+        yield "\0" * (2 * tarfile.BLOCKSIZE)
+
+
+class ZipArchive(TarArchive):
+    # zip archive with stored (uncompressed) entries, the CRCs are computed
+    # while the data is sent and written in a data descriptor after it
+
+    content_type = ZIP
+    extension = ".zip"
+
+    def fits(self):
+        # without ZIP64, which not every client understands
+        return len(self.entries) < ZIP_MAX_ENTRIES and self.content_length() < ZIP_LIMIT
+
+    def content_length(self):
+        length = ZIP_END.size
+
+        for name, _, st in self.entries:
+            length += ZIP_LOCAL_HEADER.size + ZIP_CENTRAL_HEADER.size + 2 * len(name) + ZIP_DATA_DESCRIPTOR.size
+            length += self._size(st)
+
+        return length
+
+    def _dos_time(self, st):
+        t = time.localtime(st.st_mtime)
+        if t.tm_year < 1980:
+            return 0, (1 << 5) | 1  # 1980-01-01 00:00
+
+        return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+    def __iter__(self):
+        central = []
+        offset = 0
+
+        for name, filename, st in self.entries:
+            dos_time, dos_date = self._dos_time(st)
+            size = self._size(st)
+
+            header = ZIP_LOCAL_HEADER.pack(0x04034b50, ZIP_VERSION, ZIP_FLAGS, 0, dos_time, dos_date, 0, 0, 0,
+                                           len(name), 0) + name
+            yield header
+
+            crc = 0
+            if size:
+                for buf in _read(filename, size, self.block_size):
+                    crc = zlib.crc32(buf, crc)
+                    yield buf
+
+            crc &= 0xffffffff
+            yield ZIP_DATA_DESCRIPTOR.pack(0x08074b50, crc, size, size)
+
+            external = (st.st_mode & 0xffff) << 16
+            if stat.S_ISDIR(st.st_mode):
+                external |= 0x10  # MS-DOS directory attribute
+
+            central.append(ZIP_CENTRAL_HEADER.pack(0x02014b50, (3 << 8) | ZIP_VERSION, ZIP_VERSION, ZIP_FLAGS, 0,
+                                                   dos_time, dos_date, crc, size, size, len(name), 0, 0, 0, 0,
+                                                   external, offset) + name)
+
+            offset += len(header) + size + ZIP_DATA_DESCRIPTOR.size
+
+        size = 0
+        for c in central:
+            size += len(c)
+            yield c
+
+        yield ZIP_END.pack(0x06054b50, 0, 0, len(central), len(central), size, offset, 0)
+
+
+ARCHIVES = {TAR: TarArchive, ZIP: ZipArchive}
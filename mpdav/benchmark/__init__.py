@@ -0,0 +1,19 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+from runner import run
+from scenarios import SCENARIOS
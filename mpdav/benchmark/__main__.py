@@ -0,0 +1,106 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import sys
+import tempfile
+
+import os.path
+
+from mpdav.benchmark import runner
+from mpdav.benchmark.scenarios import SCENARIOS
+
+ROW = "%-30s %-9s %-9s %10s %10s %10s %10s %8s %10s"
+
+
+def print_header(out):
+    print >> out, ROW % ("scenario", "transport", "method", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors",
+                         "rss KiB")
+
+
+def print_result(out, r):
+    latency = r["latency_ms"]
+    print >> out, ROW % (r["scenario"], r["transport"], r["method"], r["throughput"], latency["p50"],
+                         latency["p95"], latency["p99"], r["errors"], r["peak_rss_kb"])
+
+
+def compare(old_file, new_file, out):
+    # relative change of throughput and p95 latency per scenario and
+    # transport, positive is better
+    with open(old_file) as f:
+        old = dict(((r["scenario"], r["transport"]), r) for r in json.load(f)["results"])
+    with open(new_file) as f:
+        new = json.load(f)["results"]
+
+    print >> out, "%-30s %-9s %12s %12s" % ("scenario", "transport", "throughput", "p95")
+
+    for r in new:
+        before = old.get((r["scenario"], r["transport"]))
+        if before is None:
+            continue
+
+        throughput = (r["throughput"] / before["throughput"] - 1) * 100 if before["throughput"] else 0.0
+        p95 = (before["latency_ms"]["p95"] / r["latency_ms"]["p95"] - 1) * 100 if r["latency_ms"]["p95"] else 0.0
+
+        print >> out, "%-30s %-9s %+11.1f%% %+11.1f%%" % (r["scenario"], r["transport"], throughput, p95)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m mpdav.benchmark", description="mpdav benchmarks")
+    sub = parser.add_subparsers(dest="command")
+
+    run = sub.add_parser("run", help="run benchmarks")
+    run.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "mpdav-benchmark"),
+                     help="directory for the synthetic trees, reused between runs (default: %(default)s)")
+    run.add_argument("--output", help="write the results as JSON to this file (default: stdout)")
+    run.add_argument("--scenario", action="append", choices=[s.name for s in SCENARIOS],
+                     help="scenario to run, may be repeated (default: all)")
+    run.add_argument("--transport", action="append", choices=runner.TRANSPORTS,
+                     help="transport to use, may be repeated (default: all)")
+    run.add_argument("--iterations", type=int, default=200, help="requests per run (default: %(default)s)")
+    run.add_argument("--concurrency", type=int, default=8, help="concurrent clients (default: %(default)s)")
+    run.add_argument("--scale", type=float, default=1.0, help="size factor of the trees (default: %(default)s)")
+    run.add_argument("--no-isolate", action="store_true", help="run everything in this process")
+
+    cmp_ = sub.add_parser("compare", help="compare two result files")
+    cmp_.add_argument("old")
+    cmp_.add_argument("new")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.old, args.new, sys.stdout)
+        return
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+
+    print_header(sys.stderr)
+    results = runner.run(args.workdir, scenarios, args.transport or runner.TRANSPORTS, args.iterations,
+                         args.concurrency, args.scale, not args.no_isolate,
+                         lambda r: print_result(sys.stderr, r))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+
+WIDE_ENTRIES = 10000
+DEEP_LEVELS = 64
+DEEP_FILES = 8
+SMALL_DIRECTORIES = 200
+SMALL_FILES = 50
+SMALL_FILE_SIZE = 4096
+HUGE_FILES = 4
+HUGE_FILE_SIZE = 33554432
+MIN_HUGE_FILE_SIZE = 4194304  # ranged GETs stay below
+
+MARKER = "fixtures.json"
+
+
+def _write(filename, size, block):
+    with open(filename, "wb") as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def build(root, scale=1.0):
+    # Creates the synthetic trees below root, counts and sizes multiplied
+    # by scale:
+    #
+    #   wide/   one directory with many entries
+    #   deep/   a long chain of directories with a few files each
+    #   small/  many small files in a few hundred directories
+    #   huge/   a few huge files
+    #   bench/  scratch space for PUT, COPY, MOVE and DELETE
+    #
+    # Existing fixtures of the same scale are reused.
+    marker = os.path.join(root, MARKER)
+    config = {"scale": scale, "version": 1}
+
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == config:
+                return
+        shutil.rmtree(root)
+
+    if not os.path.isdir(root):
+        os.makedirs(root)
+
+    block = os.urandom(1048576)
+
+    os.mkdir(os.path.join(root, "wide"))
+    for i in range(int(WIDE_ENTRIES * scale)):
+        _write(os.path.join(root, "wide", "f%06d.txt" % i), SMALL_FILE_SIZE, block)
+
+    path = os.path.join(root, "deep")
+    for level in range(DEEP_LEVELS):
+        os.mkdir(path)
+        for i in range(DEEP_FILES):
+            _write(os.path.join(path, "f%d.txt" % i), SMALL_FILE_SIZE, block)
+        path = os.path.join(path, "l%02d" % level)
+
+    for d in range(int(SMALL_DIRECTORIES * scale)):
+        path = os.path.join(root, "small", "d%04d" % d)
+        os.makedirs(path)
+        for i in range(SMALL_FILES):
+            _write(os.path.join(path, "f%04d.txt" % i), SMALL_FILE_SIZE, block)
+
+    os.mkdir(os.path.join(root, "huge"))
+    for i in range(HUGE_FILES):
+        _write(os.path.join(root, "huge", "f%d.bin" % i), max(int(HUGE_FILE_SIZE * scale), MIN_HUGE_FILE_SIZE), block)
+
+    os.mkdir(os.path.join(root, "bench"))
+
+    with open(marker, "w") as f:
+        json.dump(config, f)
+
+
+def reset_scratch(root):
+    path = os.path.join(root, "bench")
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.mkdir(path)
+
+    return path
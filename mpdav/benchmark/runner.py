@@ -0,0 +1,239 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import StringIO
+import httplib
+import itertools
+import multiprocessing
+import platform
+import resource
+import sys
+import threading
+import time
+import urllib
+
+import mpdav
+from mpdav.server import ThreadPoolServer
+
+import fixtures
+
+TRANSPORTS = ("inprocess", "socket")
+READ_SIZE = 65536
+
+
+def percentile(values, p):
+    # nearest rank of sorted values
+    if not values:
+        return None
+
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def summarize(scenario, transport, iterations, concurrency, latencies, seconds, errors, transferred):
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return round(value * 1000.0, 3) if value is not None else None
+
+    return {"scenario": scenario.name,
+            "method": scenario.method(),
+            "transport": transport,
+            "iterations": iterations,
+            "concurrency": concurrency,
+            "errors": errors,
+            "seconds": round(seconds, 3),
+            "throughput": round(len(latencies) / seconds, 1) if seconds else None,
+            "bytes": transferred,
+            "latency_ms": {"p50": ms(percentile(latencies, 50)),
+                           "p95": ms(percentile(latencies, 95)),
+                           "p99": ms(percentile(latencies, 99)),
+                           "mean": ms(sum(latencies) / len(latencies) if latencies else None),
+                           "max": ms(latencies[-1] if latencies else None)},
+            # high-water mark of the process, i.e. of this scenario only if
+            # it ran isolated
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def _drive(send, iterations, concurrency, connect=None):
+    # Runs send(i, state) for i in range(iterations) from concurrency
+    # threads, returns latencies, wall time, errors and bytes received.
+    counter = itertools.count()
+    latencies = []
+    stats = {"errors": 0, "bytes": 0}
+    lock = threading.Lock()
+
+    def worker():
+        state = connect() if connect else None
+
+        while True:
+            i = next(counter)
+            if i >= iterations:
+                break
+
+            start = time.time()
+            try:
+                ok, received = send(i, state)
+            except (IOError, httplib.HTTPException):
+                ok, received = False, 0
+                state = connect() if connect else None
+            latencies.append(time.time() - start)
+
+            with lock:
+                stats["bytes"] += received
+                if not ok:
+                    stats["errors"] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return latencies, time.time() - start, stats["errors"], stats["bytes"]
+
+
+def run_inprocess(scenario, root, iterations, concurrency):
+    # calls WebDavRequestHandler.handle directly, no HTTP involved
+    handler = mpdav.WebDavRequestHandler(scenario.backend(root))
+
+    def send(i, state):
+        method, path, headers, body = scenario.request(i)
+
+        request_headers = mpdav.HeadersDict()
+        for k, v in headers.items():
+            request_headers[k] = "http://localhost" + v if k == "Destination" else v
+        if body:
+            request_headers["Content-Length"] = str(len(body))
+
+        r = handler.handle(method.lower(), "localhost", path.decode("utf-8"), request_headers,
+                           StringIO.StringIO(body))
+
+        received = 0
+        if r.body:
+            for chunk in r.body:
+                received += len(chunk)
+            if hasattr(r.body, "close"):
+                r.body.close()
+
+        return r.status[0] < 400, received
+
+    return _drive(send, iterations, concurrency)
+
+
+def run_socket(scenario, root, iterations, concurrency):
+    # DavWsgiApp behind the bundled server on a local socket, one keep-alive
+    # connection per client thread
+    app = mpdav.DavWsgiApp(scenario.backend(root))
+
+    if not scenario.file_wrapper:
+        wrapped = app
+
+        def app(environ, start_response):
+            environ.pop("wsgi.file_wrapper", None)
+            return wrapped(environ, start_response)
+
+    server = ThreadPoolServer(("127.0.0.1", 0), app, threads=max(concurrency, 4), quiet=True)
+    port = server.server_address[1]
+
+    t = threading.Thread(target=server.serve_forever, args=(0.1, ))
+    t.daemon = True
+    t.start()
+
+    def connect():
+        return httplib.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def send(i, connection):
+        method, path, headers, body = scenario.request(i)
+
+        headers = dict(headers)
+        if "Destination" in headers:
+            headers["Destination"] = "http://127.0.0.1:%d%s" % (port, urllib.quote(headers["Destination"]))
+
+        connection.request(method, urllib.quote(path), body, headers)
+        r = connection.getresponse()
+
+        received = 0
+        while True:
+            buf = r.read(READ_SIZE)
+            if not buf:
+                break
+            received += len(buf)
+
+        return r.status < 400, received
+
+    try:
+        return _drive(send, iterations, concurrency, connect)
+    finally:
+        server.shutdown()
+        server.stop(5.0)
+
+
+def run_scenario(scenario, transport, root, iterations, concurrency):
+    fixtures.reset_scratch(root)
+
+    if scenario.setup is not None:
+        scenario.setup(root, iterations)
+
+    func = run_inprocess if transport == "inprocess" else run_socket
+    latencies, seconds, errors, transferred = func(scenario, root, iterations, concurrency)
+
+    return summarize(scenario, transport, iterations, concurrency, latencies, seconds, errors, transferred)
+
+
+def _isolated(conn, scenario, transport, root, iterations, concurrency):
+    conn.send(run_scenario(scenario, transport, root, iterations, concurrency))
+    conn.close()
+
+
+def run(root, scenarios, transports=TRANSPORTS, iterations=200, concurrency=8, scale=1.0, isolate=True,
+        progress=None):
+    # Builds the fixtures below root and runs every scenario on every
+    # transport. With isolate each run is a child process of its own, so
+    # peak RSS is per run and caches do not carry over.
+    fixtures.build(root, scale)
+
+    results = []
+
+    for scenario in scenarios:
+        for transport in transports:
+            if transport not in scenario.transports:
+                continue
+
+            if isolate:
+                parent, child = multiprocessing.Pipe(False)
+                p = multiprocessing.Process(target=_isolated,
+                                            args=(child, scenario, transport, root, iterations, concurrency))
+                p.start()
+                result = parent.recv()
+                p.join()
+            else:
+                result = run_scenario(scenario, transport, root, iterations, concurrency)
+
+            results.append(result)
+
+            if progress is not None:
+                progress(result)
+
+    fixtures.reset_scratch(root)
+
+    return {"python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "time": int(time.time()),
+            "config": {"iterations": iterations, "concurrency": concurrency, "scale": scale, "isolate": isolate},
+            "results": results}
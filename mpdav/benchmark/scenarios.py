@@ -0,0 +1,140 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+import mpdav
+from mpdav import compression
+from mpdav.file_backend import FileBackend
+
+import fixtures
+
+PROPFIND_BODY = """<?xml version="1.0" encoding="utf-8"?>
+<D:propfind xmlns:D="DAV:"><D:prop>
+<D:resourcetype/><D:getcontentlength/><D:getlastmodified/><D:getetag/>
+</D:prop></D:propfind>"""
+
+PUT_SIZE = 65536
+RANGE_SIZE = 65536
+SLOW_STAT_DELAY = 0.002  # seconds, about a stat over NFS/SMB with a WAN link
+
+
+class SlowStatBackend(FileBackend):
+    # FileBackend on a simulated high latency file system
+    def _entry_stat(self, entry):
+        time.sleep(SLOW_STAT_DELAY)
+        return FileBackend._entry_stat(self, entry)
+
+
+class Scenario(object):
+    # One benchmark: request(i) returns the i-th request as (method, path,
+    # headers, body), a Destination header holds only the path. setup(root,
+    # iterations) prepares what the requests consume (e.g. the resources
+    # to DELETE). transports restricts where it runs, file_wrapper=False
+    # hides wsgi.file_wrapper from the application, so GET bodies are
+    # iterated instead of sent with sendfile.
+
+    def __init__(self, name, request, setup=None, backend_class=FileBackend, backend_options=None,
+                 transports=("inprocess", "socket"), file_wrapper=True):
+        self.name = name
+        self.request = request
+        self.setup = setup
+        self.backend_class = backend_class
+        self.backend_options = backend_options or {}
+        self.transports = transports
+        self.file_wrapper = file_wrapper
+
+    def method(self):
+        return self.request(0)[0]
+
+    def backend(self, root):
+        return self.backend_class(root, **self.backend_options)
+
+
+def propfind(path, depth, accept_encoding=None):
+    headers = {"Depth": depth, "Content-Type": "application/xml"}
+    if accept_encoding:
+        headers["Accept-Encoding"] = accept_encoding
+
+    return lambda i: ("PROPFIND", path, headers, PROPFIND_BODY)
+
+
+def get(path, byte_range=False):
+    def request(i):
+        headers = {}
+        if byte_range:
+            offset = (i * 7919 * RANGE_SIZE) % (fixtures.MIN_HUGE_FILE_SIZE - RANGE_SIZE)
+            headers["Range"] = "bytes=%d-%d" % (offset, offset + RANGE_SIZE - 1)
+
+        return "GET", path, headers, ""
+
+    return request
+
+
+def put(i):
+    return "PUT", "/bench/put-%d.bin" % i, {}, PUT_BODY
+
+
+def copy(i):
+    return "COPY", "/small/d0000", {"Destination": "/bench/copy-%d" % i}, ""
+
+
+def move(i):
+    return "MOVE", "/bench/move-%d.txt" % i, {"Destination": "/bench/moved-%d.txt" % i}, ""
+
+
+def delete(i):
+    return "DELETE", "/bench/delete-%d" % i, {}, ""
+
+
+def setup_move(root, iterations):
+    for i in range(iterations):
+        with open(os.path.join(root, "bench", "move-%d.txt" % i), "wb") as f:
+            f.write("x" * fixtures.SMALL_FILE_SIZE)
+
+
+def setup_delete(root, iterations):
+    for i in range(iterations):
+        path = os.path.join(root, "bench", "delete-%d" % i)
+        os.mkdir(path)
+        for j in range(fixtures.SMALL_FILES):
+            open(os.path.join(path, "f%d" % j), "wb").close()
+
+
+PUT_BODY = os.urandom(PUT_SIZE)
+
+SCENARIOS = [
+    Scenario("propfind-depth0", propfind("/wide", "0")),
+    Scenario("propfind-depth1-wide", propfind("/wide", "1")),
+    Scenario("propfind-depth1-wide-gzip", propfind("/wide", "1", "gzip"),
+             backend_options={"compressor": compression.Compressor()}),
+    Scenario("propfind-depth1-small", propfind("/small/d0000", "1")),
+    Scenario("propfind-depth1-slowfs", propfind("/small/d0000", "1"), backend_class=SlowStatBackend),
+    Scenario("propfind-depth1-slowfs-pool", propfind("/small/d0000", "1"), backend_class=SlowStatBackend,
+             backend_options={"stat_workers": 16}),
+    Scenario("get-small", get("/small/d0000/f0000.txt")),
+    Scenario("get-small-cached", get("/small/d0000/f0000.txt"),
+             backend_options={"content_cache": mpdav.ContentCache()}),
+    Scenario("get-full", get("/huge/f0.bin")),
+    Scenario("get-full-iterator", get("/huge/f0.bin"), transports=("socket", ), file_wrapper=False),
+    Scenario("get-range", get("/huge/f1.bin", True)),
+    Scenario("put", put),
+    Scenario("copy", copy),
+    Scenario("move", move, setup_move),
+    Scenario("delete", delete, setup_delete),
+]
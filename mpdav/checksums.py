@@ -0,0 +1,251 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import Queue
+import collections
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import os
+import sqlite3
+import threading
+
+NAMESPACE = "http://mpdav/ns/"
+XATTR_PREFIX = "user.mpdav."
+BLOCK_SIZE = 1048576
+MAX_MEMORY_ENTRIES = 100000
+
+# errors meaning the file system has no (user) extended attributes
+UNSUPPORTED = (errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS, errno.EPERM)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checksums (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (device, inode, mtime, size)
+)
+"""
+
+
+def _find_xattr():
+    if hasattr(os, "getxattr"):
+        return os.getxattr, os.fsetxattr
+
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None, None
+
+    libc = ctypes.CDLL(name, use_errno=True)
+    libc.getxattr.restype = ctypes.c_ssize_t
+    libc.getxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_size_t]
+    libc.fsetxattr.restype = ctypes.c_int
+    libc.fsetxattr.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int]
+
+    def getxattr(path, attribute):
+        buf = ctypes.create_string_buffer(256)
+        r = libc.getxattr(path, attribute, buf, len(buf))
+        if r < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        return buf.raw[:r]
+
+    def fsetxattr(fd, attribute, value):
+        if libc.fsetxattr(fd, attribute, value, len(value), 0) < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    return getxattr, fsetxattr
+
+
+getxattr, fsetxattr = _find_xattr()
+
+
+def _key(st):
+    # a checksum is valid as long as the file has the same device, inode,
+    # mtime and size, i.e. survives renames but no modification
+    return st.st_dev, st.st_ino, st.st_mtime, st.st_size
+
+
+class ChecksumStore(object):
+    # Content checksums of files, for strong ETags. They are computed by a
+    # pool of worker threads, never while a request waits: get() only
+    # returns what is known and queues the file otherwise. A checksum is
+    # stored in an extended attribute of the file together with the key it
+    # is valid for. Only on file systems without user xattrs it is kept in
+    # memory and in a SQLite index (if given) instead; the key of a deleted
+    # file may come back for a new one there (reused inode, mtime set by
+    # copystat), the attribute of a file can't be the one of another.
+
+    def __init__(self, workers=2, algorithm="sha256", index=None):
+        self.algorithm = algorithm
+        self.attribute = XATTR_PREFIX + algorithm
+        self.xattrs = getxattr is not None
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.memory = collections.OrderedDict()  # key -> digest
+        self.counter = 0  # computed checksums, part of response cache keys
+
+        self.db = None
+        if index is not None:
+            self.db = sqlite3.connect(index, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(SCHEMA)
+            self.db.commit()
+
+        for _ in range(max(workers, 1)):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def get(self, filename, st):
+        # the hex digest of filename (with stat result st) or None if not
+        # known yet, it is computed in the background then
+        digest = self._load(filename, _key(st))
+        if digest is not None:
+            return digest
+
+        self.update(filename)
+
+        return None
+
+    def _load(self, filename, key):
+        if self.xattrs:
+            try:
+                value = getxattr(filename.encode("utf-8"), self.attribute)
+            except OSError:
+                value = None
+
+            try:
+                device, inode, mtime, size, digest = value.split(" ")
+                if (int(device), int(inode), float(mtime), int(size)) == key:
+                    return digest
+            except (AttributeError, ValueError):
+                pass  # none or not written by us
+
+            return None
+
+        with self.lock:
+            digest = self.memory.get(key)
+
+            if digest is None and self.db is not None:
+                row = self.db.execute("SELECT digest FROM checksums "
+                                      "WHERE device = ? AND inode = ? AND mtime = ? AND size = ?", key).fetchone()
+                if row is not None:
+                    digest = str(row[0])
+                    self._remember(key, digest)
+
+        return digest
+
+    def _remember(self, key, digest):
+        # with the lock held
+        self.memory[key] = digest
+        if len(self.memory) > MAX_MEMORY_ENTRIES:
+            self.memory.popitem(last=False)
+
+    def update(self, filename):
+        # queues filename, e.g. after it was written
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.add(filename)
+
+        self.queue.put(filename)
+
+    def copied(self, source, destination):
+        # the checksum of a copy is the one of its source, if known
+        if os.path.isdir(destination):
+            for dirpath, _, filenames in os.walk(destination):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    self.copied(os.path.join(source, os.path.relpath(path, destination)), path)
+            return
+
+        try:
+            source_st = os.stat(source)
+            st = os.stat(destination)
+        except OSError:
+            return
+
+        digest = self._load(source, _key(source_st))
+        if digest is None or source_st.st_size != st.st_size:
+            self.update(destination)
+            return
+
+        with open(destination, "rb") as f:
+            self._store(f, _key(st), digest)
+
+    def _work(self):
+        while True:
+            filename = self.queue.get()
+
+            with self.lock:
+                self.pending.discard(filename)
+
+            try:
+                self._compute(filename)
+            except EnvironmentError:
+                pass  # gone or unreadable, tried again on the next get()
+
+    def _compute(self, filename):
+        with open(filename, "rb") as f:
+            key = _key(os.fstat(f.fileno()))
+
+            if self._load(filename, key) is not None:
+                return
+
+            h = hashlib.new(self.algorithm)
+            for buf in iter(lambda: f.read(BLOCK_SIZE), ""):
+                h.update(buf)
+
+            # modified while it was read, the change queues it again
+            if _key(os.fstat(f.fileno())) != key:
+                return
+
+            self._store(f, key, h.hexdigest())
+
+    def _store(self, f, key, digest):
+        with self.lock:
+            self.counter += 1
+
+        if self.xattrs:
+            try:
+                fsetxattr(f.fileno(), self.attribute, "%d %d %r %d %s" % (key + (digest, )))
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                self.xattrs = False
+
+        with self.lock:
+            self._remember(key, digest)
+
+            if self.db is not None:
+                # older checksums of the same inode are useless
+                self.db.execute("DELETE FROM checksums WHERE device = ? AND inode = ?", key[:2])
+                self.db.execute("INSERT INTO checksums VALUES (?, ?, ?, ?, ?)", key + (digest, ))
+                self.db.commit()
+
+    def version(self):
+        return self.counter
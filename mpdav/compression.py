@@ -0,0 +1,255 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import errno
+import headers_dict
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+
+SIDECAR_NAME = ".mpdav-compressed"
+
+# HTTP codings zlib can produce: gzip (RFC 1952) and deflate, which is the
+# zlib format (RFC 1950), not raw deflate
+WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+EXTENSIONS = {"gzip": ".gz", "deflate": ".zz"}
+MTIME_PRECISION = 0.00001
+
+COMPRESSIBLE_TYPES = ("application/javascript", "application/json", "application/xml", "application/xhtml+xml",
+                      "image/svg+xml")
+
+
+def weak(etag):
+    # a compressed representation is not byte-equal to the identity one
+    if etag is None or etag.startswith("W/"):
+        return etag
+
+    return "W/" + etag
+
+
+class Compressor(object):
+    # Negotiates a Content-Encoding with Accept-Encoding and compresses
+    # response bodies chunk by chunk while they are sent. Bodies smaller
+    # than min_size are not worth the CPU. stats() tells how much was
+    # compressed and how long it took.
+
+    def __init__(self, level=6, min_size=1024, codings=("gzip", "deflate")):
+        self.level = level
+        self.min_size = min_size
+        self.codings = codings
+        self.lock = threading.Lock()
+        self.counters = dict((c, [0, 0, 0, 0.0]) for c in codings)  # responses, bytes in, bytes out, seconds
+        self.sidecar_counters = [0, 0]  # hits, builds
+
+    def compressible(self, content_type, size=None):
+        if size is not None and size < self.min_size:
+            return False
+
+        content_type = content_type.split(";")[0].strip().lower()
+
+        return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+    def negotiate(self, headers):
+        # the coding with the highest qvalue, ties are broken by the order
+        # of codings. None means identity.
+        accept_encoding = headers.get("Accept-Encoding") if headers is not None else None
+        if not accept_encoding:
+            return None
+
+        qualities = headers_dict.qualities(accept_encoding)
+
+        best = None
+        best_quality = 0.0
+
+        for coding in self.codings:
+            quality = qualities.get(coding, qualities.get("*", 0.0))
+            if quality > best_quality:
+                best = coding
+                best_quality = quality
+
+        return best
+
+    def encode(self, response, headers):
+        # compresses a generated response (multistatus, collection listing)
+        # if the client accepts it; responses the backend already decided
+        # about vary on Accept-Encoding
+        if response.status[0] not in (200, 207) or "Accept-Encoding" in response.headers.get("Vary", "") or \
+                "Content-Encoding" in response.headers or hasattr(response.body, "sendfile"):
+            return response
+
+        size = response.headers.get("Content-Length")
+        if not self.compressible(response.headers.get("Content-Type", ""), int(size) if size else None):
+            return response
+
+        vary = response.headers.get("Vary")
+        response.headers["Vary"] = vary + ", Accept-Encoding" if vary else "Accept-Encoding"
+
+        coding = self.negotiate(headers)
+        if coding is not None:
+            response.headers.pop("Content-Length", None)
+            response.headers["Content-Encoding"] = coding
+            if "ETag" in response.headers:
+                response.headers["ETag"] = weak(response.headers["ETag"])
+            if response.body is not None:
+                response.body = self.stream(response.body, coding)
+
+        return response
+
+    def stream(self, chunks, coding, sink=None):
+        # sink (if given) gets the compressed data as well
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[coding])
+        bytes_in = bytes_out = 0
+        seconds = 0.0
+
+        try:
+            for chunk in chunks:
+                start = time.time()
+                data = compressor.compress(chunk)
+                seconds += time.time() - start
+                bytes_in += len(chunk)
+
+                if data:
+                    bytes_out += len(data)
+                    if sink is not None:
+                        sink(data)
+                    yield data
+
+            start = time.time()
+            data = compressor.flush()
+            seconds += time.time() - start
+            bytes_out += len(data)
+
+            if sink is not None:
+                sink(data)
+            yield data
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+            with self.lock:
+                counter = self.counters[coding]
+                counter[0] += 1
+                counter[1] += bytes_in
+                counter[2] += bytes_out
+                counter[3] += seconds
+
+    def stats(self):
+        with self.lock:
+            result = dict((c, {"responses": n, "bytes_in": i, "bytes_out": o, "seconds": s})
+                          for c, (n, i, o, s) in self.counters.items())
+            result["sidecar"] = {"hits": self.sidecar_counters[0], "builds": self.sidecar_counters[1]}
+
+        return result
+
+
+class SidecarCache(object):
+    # Precompressed copies of static files below directory, built lazily by
+    # the first request that wants a coding (while its response is streamed)
+    # and used as plain files afterwards, so sendfile works for them too. A
+    # sidecar carries the mtime of its source and is stale if that changed.
+
+    def __init__(self, directory, compressor):
+        self.directory = directory
+        self.compressor = compressor
+        self.lock = threading.Lock()
+        self.building = set()
+
+    def _path(self, relative, coding):
+        return os.path.join(self.directory, relative.strip("/")) + EXTENSIONS[coding]
+
+    def lookup(self, relative, st, coding):
+        path = self._path(relative, coding)
+
+        try:
+            # utime() only keeps microseconds and rounds on the way
+            if abs(os.stat(path).st_mtime - st.st_mtime) > MTIME_PRECISION:
+                return None
+        except OSError:
+            return None
+
+        with self.compressor.lock:
+            self.compressor.sidecar_counters[0] += 1
+
+        return path
+
+    def build(self, source, relative, st, coding):
+        # Returns the compressed content of source (an iterable of blocks)
+        # and stores it as sidecar on the way. Only one request builds a
+        # sidecar, concurrent ones just compress.
+        path = self._path(relative, coding)
+
+        with self.lock:
+            if path in self.building:
+                return self.compressor.stream(source, coding)
+            self.building.add(path)
+
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        except:
+            with self.lock:
+                self.building.discard(path)
+            raise
+
+        return self._build(source, coding, path, os.fdopen(fd, "wb"), tmp, st)
+
+    def _build(self, source, coding, path, f, tmp, st):
+        done = False
+
+        try:
+            for data in self.compressor.stream(source, coding, f.write):
+                yield data
+
+            f.close()
+            os.utime(tmp, (st.st_atime, st.st_mtime))
+            os.rename(tmp, path)
+            done = True
+
+            with self.compressor.lock:
+                self.compressor.sidecar_counters[1] += 1
+        finally:
+            f.close()
+            if not done:
+                os.remove(tmp)  # client went away or the source is unreadable
+
+            with self.lock:
+                self.building.discard(path)
+
+    def invalidate(self, relative):
+        # removes the sidecars of relative and everything below it, not
+        # needed for correctness (stale ones are detected by the mtime) but
+        # for the space
+        relative = relative.strip("/")
+        if not relative:
+            return
+
+        for coding in EXTENSIONS:
+            try:
+                os.remove(self._path(relative, coding))
+            except OSError:
+                pass
+
+        shutil.rmtree(os.path.join(self.directory, relative), True)
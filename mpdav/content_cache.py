@@ -0,0 +1,245 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import errno
+import mmap
+import os
+import threading
+import zerocopy
+
+POLICIES = ("lru", "lfu")
+
+
+class CachedFile(object):
+    def __init__(self, validator, data, mapped=False):
+        self.validator = validator  # (inode, size, mtime)
+        self.data = data  # a str or a mmap
+        self.mapped = mapped
+        self.size = validator[1]
+        self.hits = 0
+
+
+class CachedBody(object):
+    # body of a GET served from a str in the cache, the whole str is sent as
+    # is
+
+    def __init__(self, entry, offset, length, block_size):
+        self.entry = entry
+        self.offset = offset
+        self.length = length
+        self.block_size = block_size
+
+    def __iter__(self):
+        data = self.entry.data
+        if self.offset == 0 and self.length == self.entry.size:
+            return iter([data])
+
+        return self._slices()
+
+    def _slices(self):
+        data = self.entry.data
+        end = self.offset + self.length
+        for offset in xrange(self.offset, end, self.block_size):
+            yield data[offset:min(offset + self.block_size, end)]
+
+
+class MappedBody(CachedBody):
+    # Body of a GET served from a mmap in the cache. Iterable as well as
+    # file-like (read() and remaining, like FileIterator) for
+    # wsgi.file_wrapper, sendfile() writes buffers of the mapping to the
+    # socket without any copy in user space. There is no fileno(), the
+    # mapping has no descriptor positioned at the offset of this body.
+
+    def __init__(self, entry, offset, length, block_size):
+        CachedBody.__init__(self, entry, offset, length, block_size)
+        self.remaining = length
+
+    def __iter__(self):
+        while True:
+            buf = self.read(self.block_size)
+            if not buf:
+                break
+
+            yield buf
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        if size <= 0:
+            return ""
+
+        offset = self.offset + self.length - self.remaining
+        buf = self.entry.data[offset:offset + size]
+        self.remaining -= len(buf)
+
+        return buf
+
+    def sendfile(self, out_fd, timeout=None):
+        while self.remaining > 0:
+            offset = self.offset + self.length - self.remaining
+
+            try:
+                sent = os.write(out_fd, buffer(self.entry.data, offset, min(self.remaining, self.block_size)))
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    zerocopy.wait_writable(out_fd, timeout)
+                    continue
+                raise
+
+            self.remaining -= sent
+
+        return True
+
+
+class ContentCache(object):
+    # Content of frequently requested files, a file is cached on its
+    # admit_after-th request within the last max_candidates files asked for.
+    # Files up to mmap_size are read into a str, larger ones (up to
+    # max_file_size) are mapped into memory; both count against max_bytes,
+    # evicting the least recently (lru) or least frequently (lfu) used file.
+    # Entries are validated by inode, size and mtime on every request and
+    # FileBackend invalidates them on changes. Evicted mappings are unmapped
+    # once no response uses them anymore.
+    #
+    # A mapped file truncated in place by another process while it is sent
+    # makes the kernel send SIGBUS, mmap_size=None never maps files then.
+    # FileBackend itself replaces files by renaming a new one over them.
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_file_size=16 * 1024 * 1024, mmap_size=262144,
+                 policy="lru", admit_after=2, max_candidates=10000):
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of %s" % ", ".join(POLICIES))
+
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.mmap_size = mmap_size
+        self.policy = policy
+        self.admit_after = admit_after
+        self.max_candidates = max_candidates
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.candidates = collections.OrderedDict()  # filename -> requests
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def body(self, filename, st, offset, length, block_size):
+        # A body for length bytes at offset of filename from the cache or
+        # None if the file is not (yet) cached. st is the current stat
+        # result of filename.
+        validator = (st.st_ino, st.st_size, st.st_mtime)
+
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+
+            if entry is not None and entry.validator != validator:
+                self.size -= entry.size
+                entry = None
+
+            if entry is not None:
+                self.entries[filename] = entry  # most recently used
+                entry.hits += 1
+                self.hits += 1
+            else:
+                self.misses += 1
+
+                if st.st_size > self.max_file_size or st.st_size > self.max_bytes:
+                    return None
+
+                requests = self.candidates.pop(filename, 0) + 1
+                if requests < self.admit_after:
+                    self.candidates[filename] = requests
+                    if len(self.candidates) > self.max_candidates:
+                        self.candidates.popitem(last=False)
+                    return None
+
+        if entry is None:
+            entry = self._load(filename, validator)
+            if entry is None:
+                return None
+
+            self._insert(filename, entry)
+
+        if length is None:
+            length = entry.size - offset
+
+        if entry.mapped:
+            return MappedBody(entry, offset, length, block_size)
+
+        return CachedBody(entry, offset, length, block_size)
+
+    def _load(self, filename, validator):
+        try:
+            with open(filename, "rb") as f:
+                st = os.fstat(f.fileno())
+                if (st.st_ino, st.st_size, st.st_mtime) != validator:
+                    return None  # changed since the request stat'ed it
+
+                if self.mmap_size is None or st.st_size <= self.mmap_size:
+                    data = f.read()
+                    return CachedFile(validator, data) if len(data) == st.st_size else None
+
+                return CachedFile(validator, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), True)
+        except (IOError, OSError, mmap.error):
+            return None
+
+    def _insert(self, filename, entry):
+        with self.lock:
+            old = self.entries.pop(filename, None)
+            if old is not None:
+                self.size -= old.size
+
+            self.entries[filename] = entry
+            self.size += entry.size
+
+            while self.size > self.max_bytes:
+                if self.policy == "lfu":
+                    # the oldest of the least frequently used, except the
+                    # new one, which had no chance to be used yet
+                    victim = min((k for k in self.entries if k != filename), key=lambda k: self.entries[k].hits)
+                else:
+                    victim = next(iter(self.entries))
+
+                self.size -= self.entries.pop(victim).size
+                self.evictions += 1
+
+    def invalidate(self, path):
+        # removes path and everything below it
+        prefix = path.rstrip("/") + "/"
+
+        with self.lock:
+            for filename in [f for f in self.entries if f == path or f.startswith(prefix)]:
+                self.size -= self.entries.pop(filename).size
+
+            self.candidates.pop(path, None)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_ratio": float(self.hits) / requests if requests else 0.0,
+                    "evictions": self.evictions,
+                    "entries": len(self.entries),
+                    "mapped": sum(1 for e in self.entries.values() if e.mapped),
+                    "bytes": self.size}
@@ -0,0 +1,241 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import multiprocessing.pool
+import os
+import shutil
+import stat
+import threading
+import time
+import zerocopy
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+COPY_BLOCK_SIZE = 1048576
+MAX_SYSCALL_COPY = 1 << 30  # bytes per copy_file_range/sendfile call
+
+# errors meaning "not possible here", the next strategy is tried then
+UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF,
+               errno.ETXTBSY, errno.EPERM)
+
+STRATEGIES = ("reflink", "copy_file_range", "sendfile", "buffered")
+
+
+def _find_copy_file_range():
+    if hasattr(os, "copy_file_range"):
+        return lambda fd_in, fd_out, count: os.copy_file_range(fd_in, fd_out, count)
+
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+
+    try:
+        func = ctypes.CDLL(name, use_errno=True).copy_file_range
+    except (OSError, AttributeError):
+        return None  # glibc < 2.27
+
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                     ctypes.c_uint]
+
+    def copy_file_range(fd_in, fd_out, count):
+        # NULL offsets, so the file offsets are used and advanced
+        r = func(fd_in, None, fd_out, None, count, 0)
+        if r < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        return r
+
+    return copy_file_range
+
+
+copy_file_range = _find_copy_file_range()
+
+
+class Copier(object):
+    # Copies files with the cheapest mechanism the file systems support:
+    # a reflink (shared extents, no data copied at all), copy_file_range
+    # (in kernel, possibly server side on NFS 4.2), sendfile (in kernel) and
+    # finally a buffered copy through user space. Trees can be copied by a
+    # pool of workers. stats() tells how much was copied in which way.
+
+    def __init__(self, workers=0, block_size=COPY_BLOCK_SIZE):
+        self.block_size = block_size
+        self.pool = multiprocessing.pool.ThreadPool(workers) if workers > 0 else None
+        self.lock = threading.Lock()
+        self.unsupported = set()  # (strategy, source device, destination device)
+        self.counters = dict((s, [0, 0, 0.0]) for s in STRATEGIES)  # files, bytes, seconds
+
+    def copy_file(self, src, dst, metadata=False):
+        start = time.time()
+
+        with open(src, "rb") as fsrc:
+            src_st = os.fstat(fsrc.fileno())
+
+            with open(dst, "wb") as fdst:
+                devices = (src_st.st_dev, os.fstat(fdst.fileno()).st_dev)
+                size = src_st.st_size
+                offset = 0
+                strategy = None
+
+                for strategy, func in (("reflink", self._reflink),
+                                       ("copy_file_range", self._copy_file_range),
+                                       ("sendfile", self._sendfile),
+                                       ("buffered", self._buffered)):
+                    if (strategy, ) + devices in self.unsupported:
+                        continue
+
+                    try:
+                        result = func(fsrc, fdst, size, offset)
+                    except (IOError, OSError) as e:
+                        if e.errno not in UNSUPPORTED or strategy == "buffered":
+                            raise
+
+                        with self.lock:
+                            self.unsupported.add((strategy, ) + devices)
+
+                        # continue where the failed strategy stopped, all of
+                        # them write the destination sequentially
+                        offset = os.lseek(fdst.fileno(), 0, os.SEEK_CUR)
+                        fsrc.seek(offset)
+                        fdst.seek(offset)
+                        fdst.truncate(offset)
+                        continue
+
+                    if result is not None:
+                        offset = result
+                        break
+
+        if metadata:
+            shutil.copystat(src, dst)
+
+        with self.lock:
+            counter = self.counters[strategy]
+            counter[0] += 1
+            counter[1] += size
+            counter[2] += time.time() - start
+
+    def _reflink(self, fsrc, fdst, size, offset):
+        if offset:
+            return None
+
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+        return size
+
+    def _copy_file_range(self, fsrc, fdst, size, offset):
+        if copy_file_range is None:
+            return None
+
+        while offset < size:
+            n = copy_file_range(fsrc.fileno(), fdst.fileno(), min(size - offset, MAX_SYSCALL_COPY))
+            if not n:
+                break  # file got shorter
+            offset += n
+
+        return offset
+
+    def _sendfile(self, fsrc, fdst, size, offset):
+        if zerocopy.sendfile is None:
+            return None
+
+        while offset < size:
+            n = zerocopy.sendfile(fdst.fileno(), fsrc.fileno(), offset, min(size - offset, MAX_SYSCALL_COPY))
+            if not n:
+                break
+            offset += n
+
+        return offset
+
+    def _buffered(self, fsrc, fdst, size, offset):
+        shutil.copyfileobj(fsrc, fdst, self.block_size)
+
+        return fdst.tell()
+
+    def copy_tree(self, src, dst, symlinks=False):
+        # like shutil.copytree, but files are copied by the pool. Symbolic
+        # links are followed, or recreated as links with symlinks=True.
+        files = []
+        links = []
+        directories = []
+        errors = []
+
+        for dirpath, dirnames, filenames in os.walk(src, followlinks=not symlinks):
+            target = os.path.normpath(os.path.join(dst, os.path.relpath(dirpath, src)))
+            os.mkdir(target)
+            directories.append((dirpath, target))
+
+            # links to directories are listed in dirnames, but not walked
+            for f in (dirnames if symlinks else []) + filenames:
+                s = os.path.join(dirpath, f)
+                if symlinks and os.path.islink(s):
+                    links.append((os.readlink(s), os.path.join(target, f)))
+                elif os.path.isfile(s):
+                    files.append((s, os.path.join(target, f)))
+                elif f in filenames:
+                    errors.append((s, os.path.join(target, f), "not a regular file"))
+
+        # nothing is dropped silently, a move would delete it afterwards
+        if errors:
+            raise shutil.Error(errors)
+
+        for s, d in links:
+            os.symlink(s, d)
+
+        if self.pool is not None and len(files) > 1:
+            self.pool.map(self._copy_with_metadata, files)
+        else:
+            for f in files:
+                self._copy_with_metadata(f)
+
+        # deepest first, copying files changes the mtime of directories
+        for s, d in reversed(directories):
+            shutil.copystat(s, d)
+
+    def _copy_with_metadata(self, paths):
+        self.copy_file(paths[0], paths[1], True)
+
+    def move(self, src, dst):
+        # rename, or copy and delete if src and dst are on different devices
+        try:
+            os.rename(src, dst)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        # links are moved as links, like shutil.move does
+        mode = os.lstat(src).st_mode
+        if stat.S_ISLNK(mode):
+            os.symlink(os.readlink(src), dst)
+            os.remove(src)
+        elif stat.S_ISDIR(mode):
+            self.copy_tree(src, dst, True)
+            shutil.rmtree(src)
+        else:
+            self.copy_file(src, dst, True)
+            os.remove(src)
+
+    def stats(self):
+        with self.lock:
+            return dict((s, {"files": c[0], "bytes": c[1], "seconds": c[2]})
+                        for s, c in self.counters.items())
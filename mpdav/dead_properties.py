@@ -0,0 +1,127 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS properties (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (path, name)
+)
+"""
+
+
+def _range(path):
+    # bounds of the paths below path, "0" is the character following "/"
+    prefix = path.rstrip("/") + "/"
+    return prefix, prefix[:-1] + "0"
+
+
+class PropertyStore(object):
+    # Dead properties (RFC 4918 section 4) in a SQLite database. Paths are
+    # relative to the root of the backend, values are the serialized
+    # property elements. The primary key doubles as index on path, so a
+    # whole tree is read, moved, copied or deleted with a single range
+    # query. Every PROPPATCH is one transaction.
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+
+        # readers do not block the writer, and a commit does not sync the
+        # database file, only the write ahead log at checkpoints
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def get(self, path):
+        with self.lock:
+            rows = self.db.execute("SELECT name, value FROM properties WHERE path = ?", (path, )).fetchall()
+
+        return dict(rows)
+
+    def get_tree(self, path, depth):
+        # Returns the properties of path and the resources below it up to
+        # depth (0, 1 or "infinity") as dict path -> {name -> value}.
+        if depth == 0:
+            return {path: self.get(path)}
+
+        low, high = _range(path)
+
+        with self.lock:
+            rows = self.db.execute("SELECT path, name, value FROM properties "
+                                   "WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high)).fetchall()
+
+        result = {}
+
+        for p, name, value in rows:
+            if depth == 1 and p != path and "/" in p[len(low):]:
+                continue
+
+            result.setdefault(p, {})[name] = value
+
+        return result
+
+    def patch(self, path, operations):
+        # operations is a list of (name, value) tuples in document order,
+        # value None removes the property
+        with self.lock:
+            with self.db:
+                for name, value in operations:
+                    if value is None:
+                        self.db.execute("DELETE FROM properties WHERE path = ? AND name = ?", (path, name))
+                    else:
+                        self.db.execute("INSERT OR REPLACE INTO properties (path, name, value) VALUES (?, ?, ?)",
+                                        (path, name, value))
+
+    def delete(self, path):
+        with self.lock:
+            with self.db:
+                self._delete(path)
+
+    def _delete(self, path):
+        low, high = _range(path)
+        self.db.execute("DELETE FROM properties WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high))
+
+    def move(self, src, dst):
+        low, high = _range(src)
+
+        with self.lock:
+            with self.db:
+                self._delete(dst)
+                self.db.execute("UPDATE properties SET path = ? || substr(path, ?) "
+                                "WHERE path = ? OR (path >= ? AND path < ?)",
+                                (dst.rstrip("/"), len(src.rstrip("/")) + 1, src, low, high))
+
+    def copy(self, src, dst):
+        low, high = _range(src)
+
+        with self.lock:
+            with self.db:
+                self._delete(dst)
+                self.db.execute("INSERT INTO properties (path, name, value) "
+                                "SELECT ? || substr(path, ?), name, value FROM properties "
+                                "WHERE path = ? OR (path >= ? AND path < ?)",
+                                (dst.rstrip("/"), len(src.rstrip("/")) + 1, src, low, high))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -15,17 +15,83 @@
 # You should have received a copy of the GNU General Public License
 # along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
 
+import archive
+import checksums
+import compression
+import copier
+import ctypes
+import ctypes.util
+import errno
+import instrumentation
+import itertools
+import locks
 import md5
 import mimetypes
+import multiprocessing.pool
 import os.path
 import shutil
+import stat
+import tempfile
 import time
+import trash
+import uploads
+import urllib
+import uuid
+import zerocopy
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # backport for Python < 3.5
+    except ImportError:
+        scandir = None
+
+
+def _find_posix_fallocate():
+    if hasattr(os, "posix_fallocate"):
+        return os.posix_fallocate
+
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+
+    try:
+        func = ctypes.CDLL(name, use_errno=True).posix_fallocate64
+    except (OSError, AttributeError):
+        return None
+
+    func.restype = ctypes.c_int
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+    def posix_fallocate(fd, offset, length):
+        # returns the error number instead of setting errno
+        r = func(fd, offset, length)
+        if r:
+            raise OSError(r, os.strerror(r))
+
+    return posix_fallocate
+
+
+posix_fallocate = _find_posix_fallocate()
 
 import multi_status
+import properties
+import ranges
 import response
 import status
 
-BLOCK_SIZE = 8192  # just an assumption
+FILE_BLOCK_SIZE = 262144  # used for GET if sendfile is not available
+STAT_CHUNK_SIZE = 16  # entries per task of the stat pool at most
+WRITE_BLOCK_SIZE = 1048576  # used for PUT
+
+FSYNC_NONE = "none"
+FSYNC_FILE = "file"
+FSYNC_DIR = "file+dir"
+
+# the umask can only be read by setting it, so do it once on import
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 
 def epoch2iso8601(ts):
@@ -39,164 +105,931 @@ def epoch2iso1123(ts):
     return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(ts))
 
 
+class DirEntry(object):
+    # minimal stand-in for os.DirEntry if scandir is not available
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            if follow_symlinks:
+                return stat.S_ISDIR(self.stat().st_mode)
+
+            return stat.S_ISDIR(os.lstat(self.path).st_mode)
+        except OSError:
+            return False
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+
+        return self._stat
+
+
+def iter_dir(path):
+    if scandir is not None:
+        return scandir(path)
+
+    return [DirEntry(path, name) for name in os.listdir(path)]
+
+
+class DepthLimitExceeded(Exception):
+    def __init__(self, path):
+        Exception.__init__(self, path)
+        self.path = path
+
+
 class FileIterator(object):
-    def __init__(self, filename):
-        self.filename = filename
+    # Iterable as well as file-like, so WSGI servers can hand it to
+    # wsgi.file_wrapper and transmit it without copying.
+
+    def __init__(self, filename, offset=0, length=None, block_size=FILE_BLOCK_SIZE):
+        self.file = open(filename, "rb")
+        self.offset = offset
+        self.block_size = block_size
+
+        if length is None:
+            length = os.fstat(self.file.fileno()).st_size - offset
+
+        self.length = length
+        self.remaining = length
+
+        if offset:
+            self.file.seek(offset)
 
     def __iter__(self):
-        remaining = os.stat(self.filename).st_size
-        f = open(self.filename, "rb")
+        while True:
+            buf = self.read(self.block_size)
+            if not buf:
+                break
+
+            yield buf
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
 
-        while remaining > 0:
-            r = min(remaining, BLOCK_SIZE)
+        if size <= 0:
+            return ""
 
-            yield f.read(r)
+        buf = self.file.read(size)
+        self.remaining -= len(buf)
 
-            remaining -= r
+        return buf
 
-        f.close()
+    def sendfile(self, out_fd, timeout=None):
+        # Transmits the remaining bytes to out_fd with the sendfile syscall.
+        # Returns False if not available, so the caller has to fall back to
+        # iterating.
+        if zerocopy.sendfile is None:
+            return False
+
+        offset = self.offset + self.length - self.remaining
+
+        while self.remaining > 0:
+            try:
+                sent = zerocopy.sendfile(out_fd, self.file.fileno(), offset, self.remaining)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    zerocopy.wait_writable(out_fd, timeout)
+                    continue
+                raise
+
+            if not sent:
+                break
+
+            offset += sent
+            self.remaining -= sent
+
+        return True
+
+    def close(self):
+        self.file.close()
+
+
+class MultipartIterator(object):
+    def __init__(self, filename, byte_ranges, content_type, size, block_size=FILE_BLOCK_SIZE):
+        self.filename = filename
+        self.byte_ranges = byte_ranges
+        self.block_size = block_size
+        self.size = size
+        self.boundary = uuid.uuid4().hex
+
+        self.part_headers = ["\r\n--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n" %
+                             (self.boundary, content_type, ranges.content_range(offset, length, size))
+                             for offset, length in byte_ranges]
+        self.trailer = "\r\n--%s--\r\n" % self.boundary
+
+    def content_type(self):
+        return "multipart/byteranges; boundary=%s" % self.boundary
+
+    def content_length(self):
+        return (sum(len(h) for h in self.part_headers) +
+                sum(length for _, length in self.byte_ranges) +
+                len(self.trailer))
+
+    def __iter__(self):
+        for part_header, (offset, length) in zip(self.part_headers, self.byte_ranges):
+            yield part_header
+
+            part = FileIterator(self.filename, offset, length, self.block_size)
+            try:
+                for buf in part:
+                    yield buf
+            finally:
+                part.close()
+
+        yield self.trailer
 
 
 class FileBackend(object):
-    def __init__(self, root, show_hidden=False, base_path="/"):
+    def __init__(self, root, show_hidden=False, base_path="/", block_size=FILE_BLOCK_SIZE,
+                 stream_multistatus=False, infinite_depth=False, max_depth_nodes=100000,
+                 max_depth_seconds=60.0, metadata_cache=None, response_cache=None, stat_workers=0,
+                 write_block_size=WRITE_BLOCK_SIZE, preallocate=True, fsync=FSYNC_NONE, copy_workers=0,
+                 trash_workers=0, trash_rate=0, journal=None, dead_properties=None, lock_manager=None,
+                 compressor=None, precompress=False, upload_timeout=uploads.UPLOAD_TIMEOUT, archives=False,
+                 content_cache=None, checksum_store=None):
         self.root = os.path.abspath(root)
         self.show_hidden = show_hidden
         self.base_path = base_path.rstrip("/")
+        self.block_size = block_size
+        self.stream_multistatus = stream_multistatus
+        self.infinite_depth = infinite_depth
+        self.max_depth_nodes = max_depth_nodes
+        self.max_depth_seconds = max_depth_seconds
+        self.metadata_cache = metadata_cache
+        self.response_cache = response_cache
+        self.content_cache = content_cache
+        self.write_block_size = write_block_size
+        self.preallocate = preallocate
+        self.fsync = fsync
+        self.copier = copier.Copier(copy_workers)
+
+        # names used internally inside root, never visible or accessible
+        self.reserved = set([trash.TRASH_NAME])
+
+        # deleted resources are moved into the trash and removed there in the
+        # background, so a DELETE of a large tree returns immediately
+        self.trash = None
+        if trash_workers > 0:
+            self.trash = trash.Trash(os.path.join(self.root, trash.TRASH_NAME), trash_workers, trash_rate)
+
+        # GET of a collection with Accept: application/x-tar (or zip)
+        # answers with an archive of the whole tree, see archive
+        self.archives = archives
+
+        # PUT with Content-Range writes into a staged upload, the target is
+        # replaced once it is complete. 0 disables resumable uploads.
+        self.uploads = None
+        if upload_timeout > 0:
+            self.reserved.add(uploads.UPLOADS_NAME)
+            self.uploads = uploads.Uploads(os.path.join(self.root, uploads.UPLOADS_NAME), upload_timeout)
+
+        # Content-Encoding of responses, see compression.Compressor. With
+        # precompress, compressed static files are kept as sidecar files.
+        self.compressor = compressor
+        self.sidecars = None
+        if compressor is not None and precompress:
+            self.reserved.add(compression.SIDECAR_NAME)
+            self.sidecars = compression.SidecarCache(os.path.join(self.root, compression.SIDECAR_NAME), compressor)
+
+        # on file systems with a high latency per stat call (NFS, SMB, ...)
+        # entries of a directory are stat'ed in parallel
+        self.stat_workers = stat_workers
+        self.stat_pool = multiprocessing.pool.ThreadPool(stat_workers) if stat_workers > 0 else None
+
+        # live properties, custom ones can be added with properties.register()
+        self.properties = properties.Registry(properties.DEFAULT_PROPERTIES)
+
+        # write locks, in memory only unless a LockManager with a file is given
+        self.locks = lock_manager if lock_manager is not None else locks.LockManager()
+
+        # PropertyStore for PROPPATCH, without one only live properties exist
+        self.dead_properties = dead_properties
+
+        # changes are recorded for sync-collection reports (RFC 6578)
+        self.journal = journal
+        if journal is not None:
+            self.properties.register(properties.Property("{DAV:}sync-token", properties.add_sync_token,
+                                                         allprop=False))
+
+        # strong ETags from content checksums (a weak one until the checksum
+        # was computed in the background), see checksums.ChecksumStore
+        self.checksums = checksum_store
+        if checksum_store is not None:
+            self.properties.register(properties.Property("{%s}checksum" % checksums.NAMESPACE,
+                                                         properties.add_checksum, allprop=False))
+
+        # change counters of directories modified through this backend or
+        # reported by the inotify watcher of the metadata cache, used to
+        # build keys for the response cache
+        self.versions = {}
+        self.version_counter = itertools.count(1)
+        self.versions_epoch = 0
+
+        if metadata_cache is not None:
+            metadata_cache.listeners.append(self._changed_externally)
 
     def propfind(self, path, depth, request_xml):
-        # TODO implement support for allprop
+        if depth == "infinity" and not self.infinite_depth:
+            return multi_status.Error(status.FORBIDDEN, "{DAV:}propfind-finite-depth")
 
         paths = self._build_paths(path, depth)
+        plan = self._compile_plan(request_xml)
+        self._load_dead_properties(plan, os.path.join(self.root, path.strip("/")), depth)
+
+        if self.response_cache is not None and depth != "infinity":
+            return self._cached_propfind(path, depth, plan, paths)
+
+        return multi_status.MultiStatus(self._get_properties(paths, plan), self.stream_multistatus)
+
+    def _compile_plan(self, request_xml):
+        # no body at all means allprop, RFC 4918 section 9.1
+        if request_xml is None:
+            return self.properties.compile(allprop=True)
+
+        children = request_xml.find("{DAV:}propfind") or []
+
+        if "{DAV:}propname" in children:
+            return self.properties.compile(propname=True)
+        elif "{DAV:}allprop" in children:
+            return self.properties.compile(request_xml.find("{DAV:}propfind", "{DAV:}include"), allprop=True)
+
+        return self.properties.compile(request_xml.find("{DAV:}propfind", "{DAV:}prop"))
 
-        return multi_status.MultiStatus(self._get_properties(paths, request_xml))
+    def _cached_propfind(self, path, depth, plan, paths):
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+        st = self._stat(filename)
+
+        if not stat.S_ISDIR(st.st_mode):
+            return multi_status.MultiStatus(self._get_properties(paths, plan), self.stream_multistatus)
+
+        key = ("propfind", filename, depth, plan.key, st.st_mtime, self._version(filename), self.locks.version(),
+               self.checksums.version() if self.checksums is not None else 0)
+
+        cached = self.response_cache.get(key)
+        if cached is None:
+            ms = multi_status.MultiStatus(self._get_properties(paths, plan))
+            cached = self.response_cache.put(key, ms.body[0], ms.headers["Content-Type"])
+
+        return response.Response(status.MULTI_STATUS,
+                                 {"Content-Type": cached.content_type,
+                                  "Content-Length": str(len(cached.body)),
+                                  "ETag": cached.etag},
+                                 [cached.body])
+
+    def sync_collection(self, path, token, level, request_xml):
+        if self.journal is None:
+            return multi_status.Error(status.FORBIDDEN, "{DAV:}supported-report")
+
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+
+        if self._forbidden(filename):
+            return response.Response(status.FORBIDDEN)
+
+        try:
+            st = self._stat(filename)
+        except OSError:
+            raise IOError
+
+        if not stat.S_ISDIR(st.st_mode):
+            return multi_status.Error(status.FORBIDDEN, "{DAV:}supported-report")
+
+        plan = self.properties.compile(request_xml.find("{DAV:}sync-collection", "{DAV:}prop"))
+        depth = 1 if level == "1" else "infinity"
+        self._load_dead_properties(plan, filename, depth)
+
+        # the token is taken before looking at the tree, so changes made
+        # meanwhile are reported (again) by the next report
+        if token is None:
+            current = self.journal.token()
+            responses = self._get_properties(itertools.islice(self._walk(filename, st, depth), 1, None), plan)
+        else:
+            changes = self.journal.changes(token)
+            if changes is None:
+                return multi_status.Error(status.FORBIDDEN, "{DAV:}valid-sync-token")
+
+            changed, current = changes
+            responses = self._sync_changes(filename, changed, depth, plan)
+
+        return multi_status.MultiStatus(responses, self.stream_multistatus, current)
+
+    def _sync_changes(self, filename, changed, depth, plan):
+        prefix = filename.rstrip(os.sep) + os.sep
+
+        for p in sorted(changed):
+            if not p.startswith(prefix):
+                continue
+
+            names = p[len(prefix):].split(os.sep)
+            if (depth == 1 and len(names) > 1) or not all(self._show(n) for n in names):
+                continue
+
+            try:
+                st = self._stat(p)
+            except OSError:
+                # removed members are reported without their descendants,
+                # RFC 6578 section 3.5.2
+                r = multi_status.Response(self.base_path + p[len(self.root):])
+                r.add_status(status.NOT_FOUND)
+
+                yield r
+                continue
+
+            # everything below a collection that may be new as a whole (e.g.
+            # the destination of a MOVE) is reported for level infinite
+            for r in self._get_properties(self._walk(p, st, "infinity" if changed[p] and depth != 1 else 0),
+                                          plan):
+                yield r
+
+    def _load_dead_properties(self, plan, filename, depth):
+        # one query for all resources of the request, and only if the plan
+        # actually needs dead properties
+        if self.dead_properties is not None:
+            plan.dead_loader = lambda: self.dead_properties.get_tree(self._resource_key(filename), depth)
+
+    def _resource_key(self, filename):
+        return filename[len(self.root):].rstrip("/") or "/"
 
     def _build_paths(self, path, depth):
+        # Returns an iterator over (path, stat result) tuples, directories
+        # with a trailing slash. Raises IOError right away if path does not
+        # exist, everything else is done lazily while iterating.
         path = path.strip("/")
         path = os.path.abspath(os.path.join(self.root, path))
 
-        if path.startswith(self.root) and os.path.exists(path):
-            paths = [path]
+        if self._forbidden(path):
+            raise IOError
 
-            if os.path.isdir(path) and depth == 1:
-                for p in os.listdir(path):
-                    if self._show(p):
-                        paths.append(os.path.join(path, p))
+        try:
+            st = self._stat(path)
+        except OSError:
+            raise IOError
 
-            for i, p in enumerate(paths):
-                if os.path.isdir(p) and p[:-1] != "/":
-                    paths[i] = p + "/"
+        return self._walk(path, st, depth)
 
-            return paths
+    def _walk(self, path, st, depth):
+        if not stat.S_ISDIR(st.st_mode):
+            yield path, st
+            return
 
-        raise IOError
+        yield path + "/", st
 
-    def _show(self, filename):
-        return self.show_hidden or not filename.startswith(".")
+        if depth == 0:
+            return
 
-    def _get_properties(self, paths, request_xml):
-        result = []
+        count = 1
+        deadline = time.time() + self.max_depth_seconds if depth == "infinity" else None
 
-        for p in paths:
-            prop_stat = multi_status.PropStat(status.OK)
+        # depth first, one iterator over not yet visited entries per directory level
+        stack = [self._list_dir(path)]
 
+        while stack:
             try:
-                st = os.stat(p)
-                fs_st = os.statvfs(p.encode("utf-8"))
-            except:
+                with instrumentation.phase(instrumentation.PHASE_WALK):
+                    entry, entry_st = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+
+            if entry_st is None:
                 continue
 
-            name = self._build_displayname(p)
-            is_dir = os.path.isdir(p)
+            if deadline is not None:
+                count += 1
+                if count > self.max_depth_nodes or time.time() > deadline:
+                    raise DepthLimitExceeded(path)
+
+            if stat.S_ISDIR(entry_st.st_mode):
+                yield entry.path + "/", entry_st
+
+                # symbolic links are not followed to avoid cycles
+                if deadline is not None and entry.is_dir(follow_symlinks=False):
+                    stack.append(self._list_dir(entry.path))
+            else:
+                yield entry.path, entry_st
+
+    def _list_dir(self, path):
+        # Returns an iterator over (entry, stat result) tuples of a directory
+        # in listing order, stat result is None if the entry vanished. With a
+        # stat pool the entries are stat'ed in parallel.
+        try:
+            with instrumentation.phase(instrumentation.PHASE_WALK):
+                entries = [e for e in iter_dir(path) if self._show(e.name)]
+        except OSError:
+            return iter([])
+
+        if self.stat_pool is not None and len(entries) > 1:
+            # small directories are spread over all workers as well
+            chunk_size = max(1, min(STAT_CHUNK_SIZE, len(entries) // self.stat_workers))
+            return self.stat_pool.imap(self._stat_entry, entries, chunk_size)
+
+        return (self._stat_entry(e) for e in entries)
+
+    def _stat_entry(self, entry):
+        try:
+            return entry, self._entry_stat(entry)
+        except OSError:
+            return entry, None
+
+    def _stat(self, path):
+        if self.metadata_cache is not None:
+            return self.metadata_cache.stat(path)
+
+        return os.stat(path)
 
-            for property_ in request_xml.find("{DAV:}propfind", "{DAV:}prop"):
-                if property_ == "{DAV:}resourcetype":
-                    prop_stat.add_resourcetype(is_dir)
+    def _entry_stat(self, entry):
+        if self.metadata_cache is not None:
+            return self.metadata_cache.stat(entry.path)
 
-                elif property_ == "{DAV:}creationdate":
-                    prop_stat.add_creationdate(epoch2iso8601(st.st_ctime))
+        return entry.stat()
 
-                elif property_ == "{DAV:}displayname":
-                    prop_stat.add_displayname(name)
+    def _statvfs(self, path, st):
+        if self.metadata_cache is not None:
+            return self.metadata_cache.statvfs(path, st)
 
-                elif property_ == "{DAV:}getcontentlength":
-                    if not is_dir:
-                        prop_stat.add_getcontentlength(st.st_size)
+        return os.statvfs(path.encode("utf-8"))
 
-                elif property_ == "{DAV:}getcontenttype":
-                    if not is_dir:
-                        ct = mimetypes.guess_type(p)[0] or "application/octet-stream"
-                        prop_stat.add_getcontenttype(ct)
+    def _mimetype(self, path):
+        if self.metadata_cache is not None:
+            return self.metadata_cache.mimetype(path)
 
-                elif property_ == "{DAV:}getetag":
-                    prop_stat.add_getetag(md5.new("%s%s" % (name.encode("utf-8"), st.st_mtime)).hexdigest())
+        return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    def _exists(self, path):
+        try:
+            self._stat(path)
+        except OSError:
+            return False
+
+        return True
+
+    def _isdir(self, path):
+        try:
+            return stat.S_ISDIR(self._stat(path).st_mode)
+        except OSError:
+            return False
+
+    def _isfile(self, path):
+        try:
+            return stat.S_ISREG(self._stat(path).st_mode)
+        except OSError:
+            return False
+
+    def _changed(self, path):
+        # to be called after path (and everything below it) was modified
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(path, True)
+            self.metadata_cache.invalidate(os.path.dirname(path))
+
+        if self.content_cache is not None:
+            self.content_cache.invalidate(path)
+
+        if self.sidecars is not None:
+            self.sidecars.invalidate(self._resource_key(path))
+
+        self._changed_externally(path, True)
+
+    def _changed_externally(self, path, recursive):
+        if path is None:
+            self.versions_epoch += 1
+            self.versions.clear()
+
+            if self.journal is not None:
+                self.journal.reset()  # changes got lost
+            return
+
+        if self.journal is not None:
+            self.journal.record(path.rstrip("/"), recursive)
+            self.journal.record(os.path.dirname(path.rstrip("/")))
+
+        if len(self.versions) > 100000:
+            self.versions_epoch += 1
+            self.versions.clear()
+
+        # A change of path modifies the stat results of path and its parent,
+        # which show up in the Depth 1 responses of the parent and of the
+        # grandparent respectively.
+        path = path.rstrip("/")
+        parent = os.path.dirname(path)
+        self.versions[path] = self.versions[parent] = self.versions[os.path.dirname(parent)] = \
+            next(self.version_counter)
+
+    def _version(self, path):
+        return self.versions_epoch, self.versions.get(path.rstrip("/"), 0)
+
+    def _show(self, filename):
+        return filename not in self.reserved and (self.show_hidden or not filename.startswith("."))
+
+    def _forbidden(self, filename):
+        if not filename.startswith(self.root):
+            return True
+
+        return any(name in self.reserved for name in filename[len(self.root):].split(os.sep))
+
+    def _remove(self, filename):
+        if self.trash is not None and self.trash.discard(filename):
+            return
+
+        if self._isdir(filename):
+            shutil.rmtree(filename)
+        else:
+            os.remove(filename)
+
+    def _get_properties(self, paths, plan):
+        try:
+            for p, st in paths:
+                r = multi_status.Response(self.base_path + p[len(self.root):])
+                with instrumentation.phase(instrumentation.PHASE_PROPERTIES):
+                    plan.evaluate(properties.Resource(self, plan, p, st), r)
+
+                yield r
+        except DepthLimitExceeded as e:
+            r = multi_status.Response(self.base_path + e.path[len(self.root):] + "/")
+            r.add_status(status.INSUFFICIENT_STORAGE)
+            r.add_error("{DAV:}number-of-matches-within-limits")
+
+            yield r
+
+    def proppatch(self, path, operations):
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+
+        if self._forbidden(filename):
+            return response.Response(status.FORBIDDEN)
+        elif not self._exists(filename):
+            raise IOError
 
-                elif property_ == "{DAV:}getlastmodified":
-                    prop_stat.add_getlastmodified(epoch2iso1123(st.st_mtime))
+        names = []
+        for name, _ in operations:
+            if name not in names:
+                names.append(name)
 
-                elif property_ == "{DAV:}quota-available-bytes":
-                    prop_stat.add_quota_available_bytes(fs_st.f_bavail * fs_st.f_frsize)
+        # all or nothing, RFC 4918 section 9.2: live properties are computed
+        # from the file system and cannot be changed, which fails the others
+        protected = [n for n in names if n in self.properties.properties]
 
-                elif property_ == "{DAV:}quota-used-bytes":
-                    prop_stat.add_quota_used_bytes((fs_st.f_blocks - fs_st.f_bavail) * fs_st.f_frsize)
+        r = multi_status.Response(self.base_path + filename[len(self.root):])
 
+        if protected or self.dead_properties is None:
+            forbidden = multi_status.PropStat(status.FORBIDDEN)
+            failed = multi_status.PropStat(status.FAILED_DEPENDENCY)
+
+            for name in names:
+                if name in protected or self.dead_properties is None:
+                    forbidden.add_empty(name)
                 else:
-                    print "Request for not supported property %s" % property_
+                    failed.add_empty(name)
+
+            r.add(forbidden)
+            if len(failed.prop):
+                r.add(failed)
+        else:
+            self.dead_properties.patch(self._resource_key(filename), operations)
+            self._changed(filename)
+
+            ok = multi_status.PropStat(status.OK)
+            for name in names:
+                ok.add_empty(name)
+
+            r.add(ok)
+
+        return multi_status.MultiStatus([r])
+
+    def relative_path(self, url_path):
+        # path of a URL (e.g. Destination header) as passed to the methods of
+        # the backend, None if outside of base_path
+        if not url_path.startswith(self.base_path):
+            return None
+
+        return url_path[len(self.base_path):] or "/"
+
+    def lock(self, path, scope, depth, owner, timeout, tokens=()):
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+
+        if self._forbidden(filename):
+            return response.Response(status.FORBIDDEN)
+
+        created = not self._exists(filename)
+        if created:
+            if not self._isdir(os.path.dirname(filename)):
+                return response.Response(status.CONFLICT)
+
+            locked = self.check_locks(path, tokens, member=True)
+            if locked:
+                return locked
+
+        lock = self.locks.create(self._resource_key(filename), scope, depth, owner, self.locks.timeout(timeout))
+        if lock is None:
+            return multi_status.Error(status.LOCKED, "{DAV:}no-conflicting-lock")
 
-            href = self.base_path + p[len(self.root):]
+        if created:
+            # a LOCK of an unmapped URL creates an empty resource, RFC 4918
+            # section 7.3
+            try:
+                open(filename, "ab").close()
+            except EnvironmentError:
+                self.locks.release(lock.token)
+                raise
+            finally:
+                self._changed(filename)
+
+        return multi_status.LockDiscovery(status.CREATED if created else status.OK, [lock], self.base_path,
+                                          lock.token)
+
+    def refresh_lock(self, path, tokens, timeout):
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+        current = [l.token for l in self.locks.covering(self._resource_key(filename))]
+
+        lock = None
+        for token in tokens:
+            if token in current:
+                lock = self.locks.refresh(token, self.locks.timeout(timeout))
+                break
+
+        if lock is None:
+            return multi_status.Error(status.PRECONDITION_FAILED, "{DAV:}lock-token-matches-request-uri")
+
+        return multi_status.LockDiscovery(status.OK, [lock], self.base_path)
 
-            result.append(multi_status.Response(href, prop_stat))
+    def unlock(self, path, token):
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+
+        if token not in [l.token for l in self.locks.covering(self._resource_key(filename))]:
+            return multi_status.Error(status.CONFLICT, "{DAV:}lock-token-matches-request-uri")
+
+        self.locks.release(token)
+
+        return response.Response(status.NO_CONTENT)
+
+    def lock_tokens(self, path):
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+        return [l.token for l in self.locks.covering(self._resource_key(filename))]
 
-        return result
+    def check_locks(self, path, tokens, recursive=False, member=False):
+        # Returns a 423 response if path is locked and the request did not
+        # submit the lock token, None otherwise. See LockManager.missing_token
+        # for recursive and member.
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+
+        if self._forbidden(filename):
+            return None  # the method itself responds with 403
+
+        lock = self.locks.missing_token(self._resource_key(filename), tokens, recursive, member)
+        if lock is None:
+            return None
+
+        return multi_status.Error(status.LOCKED, "{DAV:}lock-token-submitted", [self.base_path + lock.path])
 
     def _build_displayname(self, path):
         cut = len(self.root)
         return os.path.basename(os.path.normpath(path[cut:]))
 
-    def head(self, path):
-        return self.get(path, False)
+    def _get_validators(self, path, st):
+        name = self._build_displayname(path)
+        etag = '"%s"' % md5.new("%s%s" % (name.encode("utf-8"), st.st_mtime)).hexdigest()
+
+        if self.checksums is not None and stat.S_ISREG(st.st_mode):
+            digest = self.checksums.get(path, st)
+            etag = '"%s"' % digest if digest is not None else "W/" + etag
 
-    def get(self, path, with_body=True):
+        return etag, epoch2iso1123(st.st_mtime)
+
+    def validators(self, path):
         filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
 
-        if not filename.startswith(self.root):
+        if self._forbidden(filename):
+            return None
+
+        try:
+            st = self._stat(filename)
+        except OSError:
+            return None
+
+        etag, last_modified = self._get_validators(filename, st)
+
+        if self.response_cache is not None and stat.S_ISDIR(st.st_mode):
+            # the ETag of a cached listing, so If-None-Match works for GET
+            # on collections as well
+            cached = self.response_cache.peek(self._listing_key(filename, st))
+            if cached is not None:
+                etag = cached.etag
+
+        return etag, last_modified, int(st.st_mtime)
+
+    def head(self, path, headers=None):
+        return self.get(path, False, headers)
+
+    def get(self, path, with_body=True, headers=None):
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+
+        if self._forbidden(filename):
             return response.Response(status.FORBIDDEN)
-        elif not os.path.exists(filename):
+        elif not self._exists(filename):
             return response.Response(status.NOT_FOUND)
 
-        if os.path.isdir(filename):
+        st = self._stat(filename)
+
+        if stat.S_ISDIR(st.st_mode):
+            if self.archives:
+                media_type = archive.negotiate(headers.get("Accept") if headers is not None else None)
+                if media_type is not None:
+                    return self._get_archive(filename, st, media_type, with_body)
+
             body = None
             content_length = "0"
+            response_headers = {"Content-Type": "text/html"}
+            if self.archives:
+                response_headers["Vary"] = "Accept"
 
-            if with_body:
+            if self.response_cache is not None:
+                key = self._listing_key(filename, st)
+
+                cached = self.response_cache.get(key)
+                if cached is None:
+                    cached = self.response_cache.put(key, self._get_collection(filename), "text/html")
+
+                body = cached.body
+                content_length = str(len(body))
+                response_headers["ETag"] = cached.etag
+            elif with_body:
                 body = self._get_collection(filename)
                 content_length = str(len(body))
 
+            response_headers["Content-Length"] = content_length
+
             return response.Response(status.OK,
-                                     {"Content-Type": "text/html",
-                                      "Content-Length": content_length},
+                                     response_headers,
                                      [body] if with_body else None)
         else:
-            st = os.stat(filename)
+            content_type = self._mimetype(filename)
+            etag, last_modified = self._get_validators(filename, st)
+
+            byte_ranges = None
+            if headers is not None and "Range" in headers and self._if_range(etag, st, headers):
+                byte_ranges = ranges.parse_range(headers["Range"], st.st_size)
+
+            if byte_ranges is None:
+                response_headers = {"Content-Type": content_type,
+                                    "Content-Length": str(st.st_size),
+                                    "Accept-Ranges": "bytes",
+                                    "ETag": etag,
+                                    "Last-Modified": last_modified}
+
+                if self.compressor is not None and self.compressor.compressible(content_type, st.st_size):
+                    response_headers["Vary"] = "Accept-Encoding"
+
+                    coding = self.compressor.negotiate(headers)
+                    if coding is not None:
+                        return self._get_compressed(filename, st, coding, response_headers, with_body)
+
+                return response.Response(status.OK,
+                                         response_headers,
+                                         self._file_body(filename, st) if with_body else None)
+            elif not byte_ranges:
+                return response.Response(status.REQUESTED_RANGE_NOT_SATISFIABLE,
+                                         {"Content-Range": "bytes */%d" % st.st_size,
+                                          "Accept-Ranges": "bytes"})
+            elif len(byte_ranges) == 1:
+                offset, length = byte_ranges[0]
+
+                return response.Response(status.PARTIAL_CONTENT,
+                                         {"Content-Type": content_type,
+                                          "Content-Length": str(length),
+                                          "Content-Range": ranges.content_range(offset, length, st.st_size),
+                                          "Accept-Ranges": "bytes",
+                                          "ETag": etag,
+                                          "Last-Modified": last_modified},
+                                         self._file_body(filename, st, offset, length) if with_body else None)
+            else:
+                body = MultipartIterator(filename, byte_ranges, content_type, st.st_size, self.block_size)
+
+                return response.Response(status.PARTIAL_CONTENT,
+                                         {"Content-Type": body.content_type(),
+                                          "Content-Length": str(body.content_length()),
+                                          "Accept-Ranges": "bytes",
+                                          "ETag": etag,
+                                          "Last-Modified": last_modified},
+                                         body if with_body else None)
+
+    def _file_body(self, filename, st, offset=0, length=None):
+        # st may be cached and older than the file, the body has to match
+        # the Content-Length taken from it anyway
+        if length is None:
+            length = st.st_size - offset
+
+        if self.content_cache is not None:
+            body = self.content_cache.body(filename, st, offset, length, self.block_size)
+            if body is not None:
+                return body
+
+        return FileIterator(filename, offset, length, self.block_size)
+
+    def _get_archive(self, filename, st, media_type, with_body):
+        # the tree is walked (with the limits of a Depth infinity PROPFIND)
+        # before anything is sent, for the Content-Length; the files are
+        # read while the archive is sent
+        name = os.path.basename(filename.rstrip("/")) or "root"
+        entries = []
+
+        try:
+            for path, entry_st in self._walk(filename, st, "infinity"):
+                if stat.S_ISDIR(entry_st.st_mode) or stat.S_ISREG(entry_st.st_mode):
+                    entries.append(((name + path[len(filename):]).encode("utf-8"), path, entry_st))
+        except DepthLimitExceeded:
+            return response.Response(status.INSUFFICIENT_STORAGE)
+
+        body = archive.ARCHIVES[media_type](entries, self.block_size)
+        if media_type == archive.ZIP and not body.fits():
+            return response.Response(status.NOT_ACCEPTABLE)  # a tar can be asked for instead
+
+        disposition = urllib.quote((name + body.extension).encode("utf-8"))
+
+        return response.Response(status.OK,
+                                 {"Content-Type": media_type,
+                                  "Content-Length": str(body.content_length()),
+                                  "Content-Disposition": "attachment; filename*=UTF-8''" + disposition,
+                                  "Vary": "Accept"},
+                                 body if with_body else None)
+
+    def _get_compressed(self, filename, st, coding, response_headers, with_body):
+        response_headers["Content-Encoding"] = coding
+        response_headers["ETag"] = compression.weak(response_headers["ETag"])
+
+        sidecar = None
+        if self.sidecars is not None:
+            sidecar = self.sidecars.lookup(self._resource_key(filename), st, coding)
+
+        if sidecar is not None:
+            body = FileIterator(sidecar, block_size=self.block_size)
+            response_headers["Content-Length"] = str(body.length)
+
+            if not with_body:
+                body.close()
+                body = None
+
+            return response.Response(status.OK, response_headers, body)
+
+        # the compressed size is not known before it was sent
+        r = response.Response(status.OK, response_headers, None)
+        del r.headers["Content-Length"]
+
+        if with_body:
+            source = FileIterator(filename, block_size=self.block_size)
+
+            if self.sidecars is not None:
+                r.body = self.sidecars.build(source, self._resource_key(filename), st, coding)
+            else:
+                r.body = self.compressor.stream(source, coding)
 
-            headers = {"Content-Type": mimetypes.guess_type(filename)[0] or "application/octet-stream",
-                       "Content-Length": str(st.st_size)}
+        return r
 
-            return response.Response(status.OK,
-                                     headers,
-                                     FileIterator(filename) if with_body else None)
+    def _if_range(self, etag, st, headers):
+        # a Range header is only honored if the If-Range validator (if any)
+        # still matches the current representation
+        if_range = headers.get("If-Range")
+        if not if_range:
+            return True
+
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return if_range == etag
+        elif if_range.startswith("W/"):
+            return False  # weak validators never match, RFC 7233 section 3.2
+
+        return ranges.http_date2epoch(if_range) == int(st.st_mtime)
+
+    def _listing_key(self, filename, st):
+        return ("listing", filename, st.st_mtime, self._version(filename))
 
     def _get_collection(self, path):
-        filenames = os.listdir(path)
+        directories = []
+        files = []
+
+        for entry in iter_dir(path):
+            if not self._show(entry.name):
+                continue
+
+            try:
+                mode = self._entry_stat(entry).st_mode
+            except OSError:
+                continue
 
-        directories = [f for f in filenames if self._show(f) and os.path.isdir(os.path.join(path, f))]
-        files = [f for f in filenames if self._show(f) and os.path.isfile(os.path.join(path, f))]
+            if stat.S_ISDIR(mode):
+                directories.append(entry.name)
+            elif stat.S_ISREG(mode):
+                files.append(entry.name)
 
         directories.sort(key=lambda d: d.lower())
         files.sort(key=lambda f: f.lower())
 
-        filenames = directories + files
-
-        result = u"""\
+        result = [u"""\
 <html>
 <head>
 <title>Content of %s</title>
@@ -204,86 +1037,245 @@ class FileBackend(object):
 </head>
 <body>
 <ul style="padding:0;margin:0;list-style-type:none;">
-""" % os.path.basename(path)
+""" % os.path.basename(path)]
 
         tplDirectory = """<li><a href="%s">[%s]</a></li>\n"""
         tplFile = """<li><a href="%s">%s</a></li>\n"""
 
-        for f in filenames:
-            p = os.path.join(path, f)
-            href = self.base_path + p[len(self.root):]
+        for tpl, filenames in ((tplDirectory, directories), (tplFile, files)):
+            for f in filenames:
+                p = os.path.join(path, f)
+                href = self.base_path + p[len(self.root):]
 
-            if os.path.isdir(p):
-                result += tplDirectory % (href, f)
-            else:
-                result += tplFile % (href, f)
+                result.append(tpl % (href, f))
 
-        result += """\
+        result.append("""\
 </ul>
 </body>
 </html>
-"""
+""")
 
-        return result.encode("utf-8")
+        return u"".join(result).encode("utf-8")
 
     def put(self, path, content_length, body):
         filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
 
-        if not filename.startswith(self.root):
+        if self._forbidden(filename):
             return response.Response(status.FORBIDDEN)
-        elif os.path.isdir(filename):
+        elif self._isdir(filename):
             return response.Response(status.NOT_ALLOWED)
-        elif not os.path.isdir(os.path.dirname(filename)):
+        elif not self._isdir(os.path.dirname(filename)):
             return response.Response(status.CONFLICT)
 
-        created = not os.path.exists(filename)
+        created = not self._exists(filename)
 
-        f = open(filename, "wb")
-        if content_length:
-            remaining = content_length
-            while remaining > 0:
-                buf = body.read(min(remaining, BLOCK_SIZE))
+        # a complete upload supersedes a staged one
+        if self.uploads is not None:
+            self.uploads.discard(self._resource_key(filename))
 
-                if len(buf):
-                    f.write(buf)
-                    remaining -= len(buf)
-                else:
-                    break
+        # Stream into a temporary file next to the target and rename it when
+        # complete, so readers never see a partial file and a failed upload
+        # leaves the previous version intact.
+        fd, tmp = tempfile.mkstemp(prefix=".~mpdav-", dir=os.path.dirname(filename))
+
+        try:
+            try:
+                with os.fdopen(fd, "wb", self.write_block_size) as f:
+                    os.fchmod(fd, 0666 & ~UMASK if created else stat.S_IMODE(self._stat(filename).st_mode))
+
+                    if content_length and self.preallocate and posix_fallocate is not None:
+                        try:
+                            posix_fallocate(fd, 0, content_length)
+                        except OSError as e:
+                            # anything else means not supported by the file system
+                            if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                                raise
+
+                    complete = self._write_body(f, content_length, body)
 
-        f.close()
+                    if self.fsync != FSYNC_NONE:
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                if not complete:
+                    os.remove(tmp)
+                    return response.Response(status.BAD_REQUEST)
+
+                os.rename(tmp, filename)
+
+                if self.checksums is not None:
+                    self.checksums.update(filename)
+            except EnvironmentError as e:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+                if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                    return response.Response(status.INSUFFICIENT_STORAGE)
+                raise
+
+            if self.fsync == FSYNC_DIR:
+                self._fsync_dir(filename)
+        finally:
+            self._changed(filename)
 
         if created:
             return response.Response(status.CREATED)
         else:
             return response.Response(status.NO_CONTENT)
 
+    def put_range(self, path, content_range, content_length, body):
+        # PUT with a Content-Range (see ranges.parse_content_range), writes
+        # into the staged upload of path. Answers 308 with a Range header
+        # telling what was received until the upload is complete, then the
+        # target is replaced atomically. "bytes */total" just asks for the
+        # Range.
+        filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
+
+        if self._forbidden(filename):
+            return response.Response(status.FORBIDDEN)
+        elif self.uploads is None:
+            return response.Response(status.BAD_REQUEST)  # RFC 7231 section 4.3.4
+        elif self._isdir(filename):
+            return response.Response(status.NOT_ALLOWED)
+        elif not self._isdir(os.path.dirname(filename)):
+            return response.Response(status.CONFLICT)
+
+        first, last, total = content_range
+        key = self._resource_key(filename)
+
+        if first is None:
+            current = self.uploads.status(key)
+            return self._resume_incomplete(current[0] if current else 0)
+        elif content_length is not None and content_length != last - first + 1:
+            return response.Response(status.BAD_REQUEST)
+
+        try:
+            upload = self.uploads.open(key, total)
+        except ValueError:
+            return response.Response(status.BAD_REQUEST)
+
+        if upload is None:
+            return response.Response(status.CONFLICT)  # another request writes to it
+
+        try:
+            if first > upload.received:
+                # no gaps, the client has to continue where the upload stopped
+                r = self._resume_incomplete(upload.received)
+                r.status = status.REQUESTED_RANGE_NOT_SATISFIABLE
+                return r
+            elif upload.total is not None and last >= upload.total:
+                return response.Response(status.BAD_REQUEST)
+
+            try:
+                with open(upload.filename, "r+b", self.write_block_size) as f:
+                    f.seek(first)
+                    complete = self._write_body(f, last - first + 1, body)
+
+                    if self.fsync != FSYNC_NONE:
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                    f.seek(0, os.SEEK_END)
+                    upload.received = f.tell()
+            except EnvironmentError as e:
+                if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                    return response.Response(status.INSUFFICIENT_STORAGE)
+                raise
+
+            if not complete:
+                return response.Response(status.BAD_REQUEST)
+            elif upload.total is None or upload.received < upload.total:
+                return self._resume_incomplete(upload.received)
+
+            created = not self._exists(filename)
+
+            os.chmod(upload.filename, 0666 & ~UMASK if created else stat.S_IMODE(self._stat(filename).st_mode))
+            os.rename(upload.filename, filename)
+            self.uploads.discard(key)
+
+            if self.checksums is not None:
+                self.checksums.update(filename)
+
+            if self.fsync == FSYNC_DIR:
+                self._fsync_dir(filename)
+
+            self._changed(filename)
+        finally:
+            self.uploads.close(upload)
+
+        if created:
+            return response.Response(status.CREATED)
+        else:
+            return response.Response(status.NO_CONTENT)
+
+    def _resume_incomplete(self, received):
+        r = response.Response(status.RESUME_INCOMPLETE)
+        if received:
+            r.headers["Range"] = "bytes=0-%d" % (received - 1)
+
+        return r
+
+    def _fsync_dir(self, filename):
+        dir_fd = os.open(os.path.dirname(filename), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _write_body(self, f, content_length, body):
+        # Copies the request body to f, content_length None means until the
+        # end of body (chunked transfer encoding). Returns False if body
+        # ended prematurely.
+        remaining = content_length
+
+        while remaining is None or remaining > 0:
+            size = self.write_block_size if remaining is None else min(remaining, self.write_block_size)
+            buf = body.read(size)
+
+            if not buf:
+                return remaining is None
+
+            f.write(buf)
+
+            if remaining is not None:
+                remaining -= len(buf)
+
+        return True
+
     def mkcol(self, path):
         dirname = os.path.abspath(os.path.join(self.root, path.strip("/")))
 
-        if not dirname.startswith(self.root):
+        if self._forbidden(dirname):
             return response.Response(status.FORBIDDEN)
-        elif os.path.exists(dirname):
+        elif self._exists(dirname):
             return response.Response(status.NOT_ALLOWED)
-        elif not os.path.isdir(os.path.dirname(dirname)):
+        elif not self._isdir(os.path.dirname(dirname)):
             return response.Response(status.CONFLICT)
 
         os.mkdir(dirname)
 
+        self._changed(dirname)
+
         return response.Response(status.CREATED, {}, None)
 
     def delete(self, path):
         filename = os.path.abspath(os.path.join(self.root, path.strip("/")))
 
-        if not filename.startswith(self.root):
+        if self._forbidden(filename):
             return response.Response(status.FORBIDDEN)
 
-        if os.path.isfile(filename):
-            os.remove(filename)
-        elif os.path.isdir(filename):
-            shutil.rmtree(filename)
-        elif not os.path.exists(filename):
+        if self._isfile(filename) or self._isdir(filename):
+            self._remove(filename)
+        elif not self._exists(filename):
             return response.Response(status.NOT_FOUND)
 
+        if self.dead_properties is not None:
+            self.dead_properties.delete(self._resource_key(filename))
+
+        self.locks.release_tree(self._resource_key(filename))
+
+        self._changed(filename)
+
         return response.Response(status.NO_CONTENT)
 
     def move(self, src, dst, overwrite):
@@ -297,26 +1289,31 @@ class FileBackend(object):
         destination = os.path.join(self.root, destination.strip("/"))
         destination = os.path.abspath(destination)
 
-        if not source.startswith(self.root) or not destination.startswith(self.root):
+        if self._forbidden(source) or self._forbidden(destination):
             return response.Response(status.FORBIDDEN)
         elif source == destination:
             return response.Response(status.FORBIDDEN)
-        elif not os.path.isdir(os.path.dirname(destination)):
+        elif not self._isdir(os.path.dirname(destination)):
             return response.Response(status.CONFLICT)
-        elif not overwrite and os.path.exists(destination):
+        elif not overwrite and self._exists(destination):
             return response.Response(status.PRECONDITION_FAILED)
 
-        created = not os.path.exists(destination)
+        created = not self._exists(destination)
+
+        if self._isdir(destination) or self._isfile(destination):
+            self._remove(destination)
+
+        if self._isdir(source) or self._isfile(source):
+            self.copier.move(source, destination)
+
+            if self.dead_properties is not None:
+                self.dead_properties.move(self._resource_key(source), self._resource_key(destination))
 
-        if os.path.isdir(destination):
-            shutil.rmtree(destination)
-        elif os.path.isfile(destination):
-            os.remove(destination)
+            # locks stay where they are, RFC 4918 section 7.7
+            self.locks.release_tree(self._resource_key(source))
 
-        if os.path.isdir(source):
-            shutil.move(source, destination)
-        elif os.path.isfile(source):
-            os.rename(source, destination)  # TODO will this work between partitions?
+        self._changed(source)
+        self._changed(destination)
 
         if created:
             return response.Response(status.CREATED)
@@ -334,26 +1331,32 @@ class FileBackend(object):
         destination = os.path.join(self.root, destination.strip("/"))
         destination = os.path.abspath(destination)
 
-        if not source.startswith(self.root) or not destination.startswith(self.root):
+        if self._forbidden(source) or self._forbidden(destination):
             return response.Response(status.FORBIDDEN)
         elif source == destination:
             return response.Response(status.FORBIDDEN)
-        elif not os.path.isdir(os.path.dirname(destination)):
+        elif not self._isdir(os.path.dirname(destination)):
             return response.Response(status.CONFLICT)
-        elif not overwrite and os.path.exists(destination):
+        elif not overwrite and self._exists(destination):
             return response.Response(status.PRECONDITION_FAILED)
 
-        created = not os.path.exists(destination)
+        created = not self._exists(destination)
+
+        if self._isdir(destination) or self._isfile(destination):
+            self._remove(destination)
+
+        if self._isdir(source):
+            self.copier.copy_tree(source, destination)
+        elif self._isfile(source):
+            self.copier.copy_file(source, destination)
+
+        if self.checksums is not None:
+            self.checksums.copied(source, destination)
 
-        if os.path.isdir(destination):
-            shutil.rmtree(destination)
-        elif os.path.isfile(destination):
-            os.remove(destination)
+        if self.dead_properties is not None:
+            self.dead_properties.copy(self._resource_key(source), self._resource_key(destination))
 
-        if os.path.isdir(source):
-            shutil.copytree(source, destination)
-        elif os.path.isfile(source):
-            shutil.copyfile(source, destination)
+        self._changed(destination)
 
         if created:
             return response.Response(status.CREATED)
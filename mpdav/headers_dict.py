@@ -39,3 +39,28 @@ class HeadersDict(collections.MutableMapping):
 
     def __len__(self):
         return len(self.store)
+
+
+def qualities(value):
+    # {lowercase token: qvalue} of an Accept-like header (Accept,
+    # Accept-Encoding, ...), parameters other than q are dropped
+    result = {}
+
+    for item in (value or "").split(","):
+        parts = item.split(";")
+        token = parts[0].strip().lower()
+        if not token:
+            continue
+
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, q = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(q)
+                except ValueError:
+                    quality = 0.0
+
+        result[token] = quality
+
+    return result
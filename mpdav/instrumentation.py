@@ -0,0 +1,324 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import sys
+import threading
+import time
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PHASE_PARSE = "parse"  # request XML
+PHASE_WALK = "walk"  # listing and stat'ing directories
+PHASE_PROPERTIES = "properties"  # evaluating properties of resources
+PHASE_SERIALIZE = "serialize"  # building response XML
+PHASE_BODY = "body"  # producing the response body while it is sent
+
+# the request being handled by the current thread, if instrumented
+_local = threading.local()
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.record.add_phase(self.name, time.time() - self.start)
+        return False
+
+
+def phase(name):
+    # Times a block as phase of the current request:
+    #
+    #   with instrumentation.phase(instrumentation.PHASE_WALK):
+    #       ...
+    #
+    # Without instrumentation this is one thread local lookup. Phases of
+    # streamed responses overlap with the body phase.
+    record = getattr(_local, "record", None)
+    if record is None:
+        return NULL_PHASE
+
+    return _Phase(record, name)
+
+
+class RequestRecord(object):
+    def __init__(self, method, path, headers):
+        self.method = method.upper()
+        self.path = path
+        self.depth = headers.get("Depth")
+        self.status = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.phases = {}
+        self.start = time.time()
+        self.duration = None
+        self.profile = None  # cProfile.Profile, see profiler
+        self.sampled = False
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+
+class CountingReader(object):
+    # request body that counts what is read from it
+    def __init__(self, stream, record):
+        self.stream = stream
+        self.record = record
+
+    def read(self, size=-1):
+        buf = self.stream.read(size)
+        self.record.bytes_in += len(buf)
+        return buf
+
+    def readline(self, size=-1):
+        buf = self.stream.readline(size)
+        self.record.bytes_in += len(buf)
+        return buf
+
+
+class InstrumentedBody(object):
+    # Response body that times producing it, counts the bytes and reports
+    # the request to the hooks when closed or exhausted.
+
+    def __init__(self, body, record, hooks):
+        self.body = body
+        self.record = record
+        self.hooks = hooks
+        self.finished = False
+
+    def __iter__(self):
+        it = iter(self.body)
+
+        while True:
+            _local.record = self.record
+            profile = self.record.profile
+            if profile is not None:
+                profile.enable()
+
+            start = time.time()
+            try:
+                chunk = next(it)
+            except StopIteration:
+                break
+            finally:
+                self.record.add_phase(PHASE_BODY, time.time() - start)
+                _local.record = None
+                if profile is not None:
+                    profile.disable()
+
+            self.record.bytes_out += len(chunk)
+
+            yield chunk
+
+        self.close()
+
+    def close(self):
+        if self.finished:
+            return
+
+        self.finished = True
+
+        if hasattr(self.body, "close"):
+            self.body.close()
+
+        finish(self.record, self.hooks)
+
+
+class InstrumentedSendfile(InstrumentedBody):
+    # the same for file-like bodies that can send themselves, see
+    # FileIterator and content_cache.MappedBody
+
+    @property
+    def block_size(self):
+        return self.body.block_size
+
+    def read(self, size=-1):
+        start = time.time()
+        buf = self.body.read(size)
+        self.record.add_phase(PHASE_BODY, time.time() - start)
+        self.record.bytes_out += len(buf)
+        return buf
+
+    def sendfile(self, out_fd, timeout=None):
+        start = time.time()
+        remaining = self.body.remaining
+        try:
+            return self.body.sendfile(out_fd, timeout)
+        finally:
+            self.record.add_phase(PHASE_BODY, time.time() - start)
+            self.record.bytes_out += remaining - self.body.remaining
+
+
+class InstrumentedFile(InstrumentedSendfile):
+    # the same for bodies backed by a file descriptor
+
+    def fileno(self):
+        return self.body.fileno()
+
+
+def begin(record, hooks):
+    _local.record = record
+
+    for hook in hooks:
+        if hasattr(hook, "request_started"):
+            hook.request_started(record)
+
+
+def end(record):
+    _local.record = None
+
+    # resumed while the body is produced
+    if record.profile is not None:
+        record.profile.disable()
+
+
+def finish(record, hooks):
+    record.duration = time.time() - record.start
+
+    for hook in hooks:
+        hook.request_finished(record)
+
+
+def wrap_body(body, record, hooks):
+    if hasattr(body, "fileno"):
+        return InstrumentedFile(body, record, hooks)
+    elif hasattr(body, "sendfile"):
+        return InstrumentedSendfile(body, record, hooks)
+
+    return InstrumentedBody(body, record, hooks)
+
+
+def _labels(**labels):
+    return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+class Metrics(object):
+    # Hook aggregating requests per method: counts by status, bytes in and
+    # out, a latency histogram and the time spent per phase. render()
+    # returns the Prometheus text exposition format.
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests = {}  # (method, status) -> count
+        self.bytes_in = {}
+        self.bytes_out = {}
+        self.latency = {}  # method -> [count per bucket..., sum, count]
+        self.phases = {}  # (method, phase) -> [sum, count]
+
+    def request_finished(self, record):
+        method = record.method
+
+        with self.lock:
+            key = (method, record.status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes_in[method] = self.bytes_in.get(method, 0) + record.bytes_in
+            self.bytes_out[method] = self.bytes_out.get(method, 0) + record.bytes_out
+
+            latency = self.latency.get(method)
+            if latency is None:
+                latency = self.latency[method] = [0] * len(self.buckets) + [0.0, 0]
+
+            for i, bound in enumerate(self.buckets):
+                if record.duration <= bound:
+                    latency[i] += 1
+            latency[-2] += record.duration
+            latency[-1] += 1
+
+            for name, seconds in record.phases.items():
+                p = self.phases.setdefault((method, name), [0.0, 0])
+                p[0] += seconds
+                p[1] += 1
+
+    def render(self):
+        lines = []
+
+        with self.lock:
+            lines.append("# HELP mpdav_requests_total Requests by method and status.")
+            lines.append("# TYPE mpdav_requests_total counter")
+            for (method, status), count in sorted(self.requests.items()):
+                lines.append("mpdav_requests_total{%s} %d" % (_labels(method=method, status=status), count))
+
+            for name, values in (("mpdav_request_bytes_total", self.bytes_in),
+                                 ("mpdav_response_bytes_total", self.bytes_out)):
+                lines.append("# TYPE %s counter" % name)
+                for method, count in sorted(values.items()):
+                    lines.append("%s{%s} %d" % (name, _labels(method=method), count))
+
+            lines.append("# HELP mpdav_request_duration_seconds Time from dispatch to the end of the response.")
+            lines.append("# TYPE mpdav_request_duration_seconds histogram")
+            for method, latency in sorted(self.latency.items()):
+                for bound, count in zip(self.buckets, latency):
+                    lines.append("mpdav_request_duration_seconds_bucket{%s} %d" %
+                                 (_labels(method=method, le=repr(bound)), count))
+                lines.append("mpdav_request_duration_seconds_bucket{%s} %d" %
+                             (_labels(method=method, le="+Inf"), latency[-1]))
+                lines.append("mpdav_request_duration_seconds_sum{%s} %f" % (_labels(method=method), latency[-2]))
+                lines.append("mpdav_request_duration_seconds_count{%s} %d" % (_labels(method=method), latency[-1]))
+
+            lines.append("# HELP mpdav_phase_seconds Time spent per phase of a request.")
+            lines.append("# TYPE mpdav_phase_seconds summary")
+            for (method, name), (seconds, count) in sorted(self.phases.items()):
+                labels = _labels(method=method, phase=name)
+                lines.append("mpdav_phase_seconds_sum{%s} %f" % (labels, seconds))
+                lines.append("mpdav_phase_seconds_count{%s} %d" % (labels, count))
+
+        return "\n".join(lines) + "\n"
+
+
+class AccessLog(object):
+    # Hook writing one JSON object per request to stream
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def request_finished(self, record):
+        entry = {"time": round(record.start, 3),
+                 "method": record.method,
+                 "path": record.path,
+                 "status": record.status,
+                 "duration_ms": round(record.duration * 1000.0, 3),
+                 "bytes_in": record.bytes_in,
+                 "bytes_out": record.bytes_out,
+                 "phases_ms": dict((k, round(v * 1000.0, 3)) for k, v in record.phases.items())}
+        if record.depth is not None:
+            entry["depth"] = record.depth
+
+        line = json.dumps(entry, sort_keys=True) + "\n"
+
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
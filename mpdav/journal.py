@@ -0,0 +1,141 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import itertools
+import os
+import threading
+import uuid
+
+TOKEN_PREFIX = "http://mpdav/ns/sync/"
+
+
+class ChangeJournal(object):
+    # Append-only log of changed paths, the base of sync-collection reports
+    # (RFC 6578). A sync token is the journal id plus the sequence number of
+    # the last entry, so the changes since a token are simply the entries
+    # after it. Only the last max_entries are kept, older tokens become
+    # invalid and clients have to do a full sync then. With a filename the
+    # journal survives restarts, otherwise every start invalidates all
+    # tokens.
+
+    def __init__(self, filename=None, max_entries=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.deque()
+        self.first = 1  # sequence number of entries[0]
+        self.file = None
+
+        if filename is not None and os.path.exists(filename):
+            self._load()
+        else:
+            self.id = uuid.uuid4().hex
+
+        if filename is not None:
+            self._compact()
+
+    def _load(self):
+        with open(self.filename, "rb") as f:
+            header = f.readline().split()
+            self.id = header[0]
+            self.first = int(header[1])
+
+            for line in f:
+                if line.endswith("\n"):  # the last line may be incomplete after a crash
+                    self.entries.append((line[2:-1].decode("utf-8"), line[0] == "1"))
+
+    def _compact(self):
+        # rewrites the file with the retained entries only
+        while len(self.entries) > self.max_entries:
+            self.entries.popleft()
+            self.first += 1
+
+        if self.file is not None:
+            self.file.close()
+
+        tmp = self.filename + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write("%s %d\n" % (self.id, self.first))
+            for entry in self.entries:
+                f.write(self._line(entry))
+
+        os.rename(tmp, self.filename)
+
+        self.file = open(self.filename, "ab")
+
+    def _line(self, entry):
+        return "%d %s\n" % (entry[1], entry[0].encode("utf-8"))
+
+    def record(self, path, recursive=False):
+        # recursive means everything below path may have changed as well
+        if isinstance(path, str):
+            path = path.decode("utf-8", "replace")
+
+        with self.lock:
+            self.entries.append((path, recursive))
+
+            if self.file is not None:
+                self.file.write(self._line((path, recursive)))
+                self.file.flush()
+
+                if len(self.entries) > 2 * self.max_entries:
+                    self._compact()
+            elif len(self.entries) > self.max_entries:
+                self.entries.popleft()
+                self.first += 1
+
+    def reset(self):
+        # forget everything, e.g. after changes got lost (inotify overflow)
+        with self.lock:
+            self.id = uuid.uuid4().hex
+            self.first += len(self.entries)
+            self.entries.clear()
+
+            if self.file is not None:
+                self._compact()
+
+    def token(self):
+        with self.lock:
+            return self._token()
+
+    def _token(self):
+        return "%s%s-%d" % (TOKEN_PREFIX, self.id, self.first + len(self.entries) - 1)
+
+    def changes(self, token):
+        # Returns a dict of the paths changed since token (path -> recursive)
+        # and the current token, or None if token is not (or no longer)
+        # valid.
+        if not token.startswith(TOKEN_PREFIX):
+            return None
+
+        journal_id, _, seq = token[len(TOKEN_PREFIX):].partition("-")
+
+        with self.lock:
+            try:
+                seq = int(seq)
+            except ValueError:
+                return None
+
+            if journal_id != self.id or not self.first - 1 <= seq < self.first + len(self.entries):
+                return None
+
+            changed = {}
+            for path, recursive in itertools.islice(self.entries, seq - self.first + 1, None):
+                changed[path] = changed.get(path, False) or recursive
+
+            return changed, self._token()
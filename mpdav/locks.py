@@ -0,0 +1,329 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+import uuid
+
+SCOPE_EXCLUSIVE = "exclusive"
+SCOPE_SHARED = "shared"
+
+DEFAULT_TIMEOUT = 3600
+MAX_TIMEOUT = 86400  # also used for "Infinite"
+
+
+class Lock(object):
+    def __init__(self, path, scope, depth, owner, timeout, token=None, expires=None):
+        self.path = path  # lock root, relative to the root of the backend
+        self.scope = scope
+        self.depth = depth  # 0 or "infinity"
+        self.owner = owner  # serialized <owner> element or None
+        self.timeout = timeout
+        self.token = token or "opaquelocktoken:%s" % uuid.uuid4()
+        self.expires = expires or time.time() + timeout
+
+    def remaining(self):
+        return max(int(self.expires - time.time()), 0)
+
+    def to_json(self):
+        return {"path": self.path, "scope": self.scope, "depth": self.depth, "owner": self.owner,
+                "timeout": self.timeout, "token": self.token, "expires": self.expires}
+
+
+class TimerWheel(object):
+    # Expiry times hashed into a ring of one second slots, so advancing the
+    # clock only looks at the slots passed since the last call instead of
+    # at every item. Items of later rounds stay in their slot.
+
+    def __init__(self, slots=1024):
+        self.slots = [set() for _ in range(slots)]
+        self.tick = int(time.time())
+
+    def add(self, item):
+        self.slots[int(item.expires) % len(self.slots)].add(item)
+
+    def remove(self, item):
+        self.slots[int(item.expires) % len(self.slots)].discard(item)
+
+    def advance(self, now):
+        # returns the items expired until now
+        n = len(self.slots)
+        target = int(now)
+        expired = []
+
+        for t in range(max(self.tick, target - n + 1), target + 1):
+            slot = self.slots[t % n]
+            if slot:
+                due = [item for item in slot if item.expires <= now]
+                slot.difference_update(due)
+                expired.extend(due)
+
+        self.tick = target
+
+        return expired
+
+
+class _Node(object):
+    __slots__ = ("children", "locks", "exclusive_below", "shared_below")
+
+    def __init__(self):
+        self.children = {}
+        self.locks = []  # rooted at this node
+        self.exclusive_below = 0  # counts include the locks of this node
+        self.shared_below = 0
+
+
+def _split(path):
+    return [name for name in path.split("/") if name]
+
+
+class LockManager(object):
+    # Write locks (RFC 4918 section 6) in a trie of path components. Every
+    # node counts the locks in its subtree, so whether a path, one of its
+    # ancestors or one of its descendants is locked is answered by walking
+    # the path once, without looking at unrelated locks. Expired locks are
+    # dropped through a timer wheel on every access. With a filename the
+    # locks are written to it on every change and loaded again on start.
+
+    def __init__(self, filename=None, default_timeout=DEFAULT_TIMEOUT, max_timeout=MAX_TIMEOUT):
+        self.filename = filename
+        self.default_timeout = default_timeout
+        self.max_timeout = max_timeout
+        self.lock = threading.Lock()
+        self.root = _Node()
+        self.tokens = {}
+        self.wheel = TimerWheel()
+        self.generation = 0  # changes whenever a lock is added or removed
+
+        if filename is not None and os.path.exists(filename):
+            with open(filename, "rb") as f:
+                for data in json.load(f):
+                    if data["expires"] > time.time():
+                        self._add(Lock(**data))
+
+    def timeout(self, value):
+        # the granted timeout for a Timeout header (RFC 4918 section 10.7)
+        for t in (value or "").split(","):
+            t = t.strip()
+            if t == "Infinite":
+                return self.max_timeout
+            elif t.startswith("Second-") and t[7:].isdigit():
+                return min(int(t[7:]), self.max_timeout)
+
+        return self.default_timeout
+
+    def create(self, path, scope, depth, owner, timeout):
+        # returns the new lock or None if it conflicts with an existing one
+        with self.lock:
+            self._expire()
+
+            covering = self._covering(path)
+            if any(scope == SCOPE_EXCLUSIVE or l.scope == SCOPE_EXCLUSIVE for l in covering):
+                return None
+
+            if depth == "infinity":
+                node = self._find(path)
+                if node is not None:
+                    if node.exclusive_below or (scope == SCOPE_EXCLUSIVE and node.shared_below):
+                        return None
+
+            lock = Lock(path, scope, depth, owner, timeout)
+            self._add(lock)
+            self._save()
+
+            return lock
+
+    def refresh(self, token, timeout):
+        with self.lock:
+            self._expire()
+
+            lock = self.tokens.get(token)
+            if lock is not None:
+                self.wheel.remove(lock)
+                lock.timeout = timeout
+                lock.expires = time.time() + timeout
+                self.wheel.add(lock)
+                self._save()
+
+            return lock
+
+    def release(self, token):
+        with self.lock:
+            self._expire()
+
+            lock = self.tokens.get(token)
+            if lock is not None:
+                self._remove(lock)
+                self._save()
+
+            return lock
+
+    def release_tree(self, path):
+        # removes the locks of path and everything below it, e.g. after a
+        # DELETE
+        with self.lock:
+            node = self._find(path)
+            if node is None or not (node.exclusive_below or node.shared_below):
+                return
+
+            for lock in self._below(node):
+                self._remove(lock)
+
+            self._save()
+
+    def version(self):
+        # changes whenever the set of locks changes, e.g. for cache keys
+        with self.lock:
+            self._expire()
+            return self.generation
+
+    def covering(self, path):
+        # the locks that apply to path, its own and the depth infinity locks
+        # of its ancestors
+        with self.lock:
+            self._expire()
+            return self._covering(path)
+
+    def missing_token(self, path, tokens, recursive=False, member=False):
+        # Returns a lock for which the request did not submit the token, or
+        # None. recursive includes the locks below path (DELETE and MOVE of
+        # a collection), member the depth 0 locks of the parent (adding or
+        # removing a member changes the collection).
+        with self.lock:
+            self._expire()
+
+            covering = self._covering(path)
+            if covering and not any(l.token in tokens for l in covering):
+                return covering[0]
+
+            if member:
+                names = _split(path)
+                parent = self._find("/".join(names[:-1]))
+                if parent is not None:
+                    for l in parent.locks:
+                        if l.depth == 0 and l.token not in tokens:
+                            return l
+
+            if recursive:
+                node = self._find(path)
+                if node is not None and (node.exclusive_below or node.shared_below):
+                    for l in self._below(node):
+                        if l.path != path and l.token not in tokens:
+                            return l
+
+            return None
+
+    def _covering(self, path):
+        names = _split(path)
+        node = self.root
+        result = []
+
+        for i in range(len(names) + 1):
+            if i == len(names):
+                result.extend(node.locks)
+                break
+
+            result.extend(l for l in node.locks if l.depth == "infinity")
+
+            node = node.children.get(names[i])
+            if node is None:
+                break
+
+        return result
+
+    def _find(self, path):
+        node = self.root
+
+        for name in _split(path):
+            node = node.children.get(name)
+            if node is None:
+                return None
+
+        return node
+
+    def _below(self, node):
+        result = []
+        stack = [node]
+
+        while stack:
+            n = stack.pop()
+            result.extend(n.locks)
+            stack.extend(c for c in n.children.values() if c.exclusive_below or c.shared_below)
+
+        return result
+
+    def _add(self, lock):
+        node = self.root
+        self._count(node, lock, 1)
+
+        for name in _split(lock.path):
+            node = node.children.setdefault(name, _Node())
+            self._count(node, lock, 1)
+
+        node.locks.append(lock)
+        self.tokens[lock.token] = lock
+        self.wheel.add(lock)
+        self.generation += 1
+
+    def _remove(self, lock):
+        nodes = [self.root]
+        for name in _split(lock.path):
+            nodes.append(nodes[-1].children[name])
+
+        nodes[-1].locks.remove(lock)
+
+        for node in nodes:
+            self._count(node, lock, -1)
+
+        # prune nodes without locks below them
+        names = _split(lock.path)
+        for i in range(len(names), 0, -1):
+            node = nodes[i]
+            if node.exclusive_below or node.shared_below or node.children:
+                break
+            del nodes[i - 1].children[names[i - 1]]
+
+        del self.tokens[lock.token]
+        self.wheel.remove(lock)
+        self.generation += 1
+
+    def _count(self, node, lock, n):
+        if lock.scope == SCOPE_EXCLUSIVE:
+            node.exclusive_below += n
+        else:
+            node.shared_below += n
+
+    def _expire(self):
+        expired = self.wheel.advance(time.time())
+
+        for lock in expired:
+            self._remove(lock)
+
+        if expired:
+            self._save()
+
+    def _save(self):
+        if self.filename is None:
+            return
+
+        tmp = self.filename + ".tmp"
+        with open(tmp, "wb") as f:
+            json.dump([l.to_json() for l in self.tokens.values()], f)
+
+        os.rename(tmp, self.filename)
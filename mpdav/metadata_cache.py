@@ -0,0 +1,265 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import mimetypes
+import os
+import stat
+import struct
+import sys
+import threading
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+           IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher(object):
+    # Watches directories with Linux' inotify (via ctypes, so there is no
+    # dependency) and calls callback(path, recursive) for every changed path.
+    # Note that inotify does not see changes made by other NFS clients, that
+    # is what the TTL of the cache is for.
+
+    def __init__(self, callback, max_watches=8192):
+        self.callback = callback
+        self.max_watches = max_watches
+        self.lock = threading.Lock()
+        self.paths = {}  # directory => watch descriptor
+        self.directories = {}  # watch descriptor => directory
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        self.thread = threading.Thread(target=self._run, name="mpdav-inotify")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith("linux") and ctypes.util.find_library("c") is not None
+
+    def watch(self, directory):
+        with self.lock:
+            if directory in self.paths or len(self.paths) >= self.max_watches:
+                return
+
+            encoded = directory.encode(sys.getfilesystemencoding()) if isinstance(directory, unicode) else directory
+            wd = self.libc.inotify_add_watch(self.fd, encoded, IN_MASK)
+            if wd >= 0:
+                self.paths[directory] = wd
+                self.directories[wd] = directory
+
+    def _run(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip("\0")
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    self.callback(None, True)
+                    continue
+
+                with self.lock:
+                    directory = self.directories.get(wd)
+
+                    if mask & IN_IGNORED and directory is not None:
+                        del self.directories[wd]
+                        del self.paths[directory]
+
+                if directory is None:
+                    continue
+
+                # the directory itself changed too, e.g. its mtime
+                self.callback(directory, False)
+
+                if name:
+                    path = os.path.join(directory, name.decode(sys.getfilesystemencoding()))
+                    self.callback(path, bool(mask & IN_ISDIR))
+
+
+class MetadataCache(object):
+    # Bounded LRU cache for stat, statvfs and mimetype lookups shared across
+    # requests. FileBackend invalidates entries when it changes something
+    # itself, out-of-band changes are picked up by inotify (if available)
+    # and finally by expiring entries after ttl seconds.
+
+    def __init__(self, max_entries=65536, ttl=10.0, watch=True, max_watches=8192):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # path => (expires, stat result or OSError)
+        self.fs_stats = {}  # device => (expires, statvfs result)
+        self.mimetypes = {}  # extension => mimetype
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self.listeners = []
+
+        self.watcher = None
+        if watch and InotifyWatcher.available():
+            try:
+                self.watcher = InotifyWatcher(self._changed, max_watches)
+            except OSError:
+                pass
+
+    def stat(self, path):
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                del self.entries[path]  # move to the end, i.e. most recently used
+                self.entries[path] = entry
+                result = entry[1]
+            else:
+                self.misses += 1
+                result = None
+
+        if result is None:
+            try:
+                result = os.stat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                result = e  # remember missing paths as well
+
+            self._store(path, result, now)
+
+            if self.watcher is not None:
+                self.watcher.watch(os.path.dirname(path))
+                if not isinstance(result, OSError) and stat.S_ISDIR(result.st_mode):
+                    self.watcher.watch(path)
+
+        if isinstance(result, OSError):
+            raise result
+
+        return result
+
+    def _store(self, path, result, now):
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries[path] = (now + self.ttl, result)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def statvfs(self, path, st):
+        # the result is the same for all paths on a file system
+        now = time.time()
+
+        with self.lock:
+            entry = self.fs_stats.get(st.st_dev)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+        result = os.statvfs(path.encode("utf-8") if isinstance(path, unicode) else path)
+
+        with self.lock:
+            self.fs_stats[st.st_dev] = (now + self.ttl, result)
+
+        return result
+
+    def mimetype(self, path):
+        extension = os.path.splitext(path)[1].lower()
+
+        with self.lock:
+            if extension in self.mimetypes:
+                self.hits += 1
+                return self.mimetypes[extension]
+
+            self.misses += 1
+
+        result = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        if extension and len(self.mimetypes) < 4096:
+            with self.lock:
+                self.mimetypes[extension] = result
+
+        return result
+
+    def invalidate(self, path, recursive=False):
+        with self.lock:
+            self.invalidations += 1
+
+            if path is None:
+                self.entries.clear()
+                self.fs_stats.clear()
+                return
+
+            path = path.rstrip("/") or "/"
+            self.entries.pop(path, None)
+            self.entries.pop(path + "/", None)
+
+            if recursive:
+                prefix = path.rstrip("/") + "/"
+                for p in [p for p in self.entries if p.startswith(prefix)]:
+                    del self.entries[p]
+
+    def _changed(self, path, recursive):
+        self.invalidate(path, recursive)
+
+        for listener in self.listeners:
+            listener(path, recursive)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "entries": len(self.entries),
+                    "watches": len(self.watcher.paths) if self.watcher is not None else 0}
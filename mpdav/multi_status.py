@@ -16,10 +16,38 @@
 # along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
 
 import xml.etree.ElementTree as etree
+import instrumentation
 import response
 import status
 
 etree.register_namespace("D", "DAV:")
+etree.register_namespace("M", "http://mpdav/ns/")
+
+STREAM_CHUNK_SIZE = 65536
+
+
+def parse_xml(xml):
+    if isinstance(xml, unicode):
+        xml = xml.encode("utf-8")
+
+    return etree.fromstring(xml)
+
+
+def lock_discovery(locks, base_path):
+    discovery = etree.Element("{DAV:}lockdiscovery")
+
+    for lock in locks:
+        active = etree.SubElement(discovery, "{DAV:}activelock")
+        etree.SubElement(etree.SubElement(active, "{DAV:}locktype"), "{DAV:}write")
+        etree.SubElement(etree.SubElement(active, "{DAV:}lockscope"), "{DAV:}" + lock.scope)
+        etree.SubElement(active, "{DAV:}depth").text = str(lock.depth)
+        if lock.owner:
+            active.append(parse_xml(lock.owner))
+        etree.SubElement(active, "{DAV:}timeout").text = "Second-%d" % lock.remaining()
+        etree.SubElement(etree.SubElement(active, "{DAV:}locktoken"), "{DAV:}href").text = lock.token
+        etree.SubElement(etree.SubElement(active, "{DAV:}lockroot"), "{DAV:}href").text = base_path + lock.path
+
+    return discovery
 
 
 def indent_xml(element):
@@ -59,6 +87,22 @@ class PropStat(object):
         self.prop = etree.SubElement(self.xml, "{DAV:}prop")
         etree.SubElement(self.xml, "{DAV:}status").text = "HTTP/1.1 %s %s" % status
 
+    def add_empty(self, name):
+        etree.SubElement(self.prop, name)
+
+    def add_xml(self, xml):
+        self.prop.append(parse_xml(xml))
+
+    def add_lockdiscovery(self, locks, base_path):
+        self.prop.append(lock_discovery(locks, base_path))
+
+    def add_supportedlock(self):
+        supportedlock = etree.SubElement(self.prop, "{DAV:}supportedlock")
+        for scope in ("{DAV:}exclusive", "{DAV:}shared"):
+            entry = etree.SubElement(supportedlock, "{DAV:}lockentry")
+            etree.SubElement(etree.SubElement(entry, "{DAV:}lockscope"), scope)
+            etree.SubElement(etree.SubElement(entry, "{DAV:}locktype"), "{DAV:}write")
+
     def add_creationdate(self, creationdate):
         etree.SubElement(self.prop, "{DAV:}creationdate").text = creationdate
 
@@ -83,10 +127,16 @@ class PropStat(object):
             etree.SubElement(resourcetype, "{DAV:}collection")
 
     def add_quota_available_bytes(self, byte_count):
-        etree.SubElement(self.prop, "{DAV:}quota-available-byte_count").text = "%s" % byte_count
+        etree.SubElement(self.prop, "{DAV:}quota-available-bytes").text = "%s" % byte_count
 
     def add_quota_used_bytes(self, byte_count):
-        etree.SubElement(self.prop, "{DAV:}quota-used-byte_count").text = "%s" % byte_count
+        etree.SubElement(self.prop, "{DAV:}quota-used-bytes").text = "%s" % byte_count
+
+    def add_checksum(self, checksum):
+        etree.SubElement(self.prop, "{http://mpdav/ns/}checksum").text = checksum
+
+    def add_sync_token(self, token):
+        etree.SubElement(self.prop, "{DAV:}sync-token").text = token
 
 
 class Response(object):
@@ -99,16 +149,96 @@ class Response(object):
     def add(self, child):
         self.xml.append(child.xml)
 
+    def add_status(self, status):
+        etree.SubElement(self.xml, "{DAV:}status").text = "HTTP/1.1 %s %s" % status
+
+    def add_error(self, condition):
+        error = etree.SubElement(self.xml, "{DAV:}error")
+        etree.SubElement(error, condition)
+
+
+class Error(response.Response):
+    # response with a precondition/postcondition code as body, RFC 4918 section 16
+    def __init__(self, status, condition, hrefs=()):
+        response.Response.__init__(self, status)
+
+        error = etree.Element("{DAV:}error")
+        element = etree.SubElement(error, condition)
+        for href in hrefs:
+            etree.SubElement(element, "{DAV:}href").text = href
+
+        xml = etree.tostring(error, encoding="UTF-8")
+
+        self.headers["Content-Type"] = 'application/xml; charset="utf-8"'
+        self.headers["Content-Length"] = str(len(xml))
+        self.body = [xml]
+
+
+class LockDiscovery(response.Response):
+    # body of a LOCK response, RFC 4918 section 9.10.1
+    def __init__(self, status, locks, base_path, lock_token=None):
+        response.Response.__init__(self, status)
+
+        prop = etree.Element("{DAV:}prop")
+        prop.append(lock_discovery(locks, base_path))
+
+        xml = etree.tostring(prop, encoding="UTF-8")
+
+        self.headers["Content-Type"] = 'application/xml; charset="utf-8"'
+        self.headers["Content-Length"] = str(len(xml))
+        if lock_token is not None:
+            self.headers["Lock-Token"] = "<%s>" % lock_token
+        self.body = [xml]
+
 
 class MultiStatus(response.Response):
-    def __init__(self, childs=None):
+    def __init__(self, childs=None, stream=False, sync_token=None):
         response.Response.__init__(self, status.MULTI_STATUS)
 
-        self.multistatus = etree.Element("{DAV:}multistatus")
+        self.headers["Content-Type"] = 'application/xml; charset="utf-8"'
+
+        if stream:
+            # serialize each child on its own while the body is sent, so
+            # neither the tree nor the document is ever held as a whole
+            del self.headers["Content-Length"]
+            self.body = self._stream(childs or [], sync_token)
+        else:
+            self.multistatus = etree.Element("{DAV:}multistatus")
+            for c in childs:
+                self.multistatus.append(c.xml)
+
+            if sync_token is not None:
+                etree.SubElement(self.multistatus, "{DAV:}sync-token").text = sync_token
+
+            with instrumentation.phase(instrumentation.PHASE_SERIALIZE):
+                xml = etree.tostring(self.multistatus, encoding="UTF-8")
+
+            self.headers["Content-Length"] = str(len(xml))
+            self.body = [xml]
+
+    def _stream(self, childs, sync_token):
+        chunk = ['<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n<D:multistatus xmlns:D="DAV:">']
+        size = len(chunk[0])
+
         for c in childs:
-            self.multistatus.append(c.xml)
+            # lowercase encoding name, so no XML declaration is written
+            with instrumentation.phase(instrumentation.PHASE_SERIALIZE):
+                xml = etree.tostring(c.xml, encoding="utf-8")
 
-        xml = etree.tostring(self.multistatus, encoding="UTF-8")
+            chunk.append(xml)
+            size += len(xml)
 
-        self.headers["Content-Length"] = str(len(xml))
-        self.body = [xml]
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+
+                chunk = []
+                size = 0
+
+        if sync_token is not None:
+            token = etree.Element("{DAV:}sync-token")
+            token.text = sync_token
+            chunk.append(etree.tostring(token, encoding="utf-8"))
+
+        chunk.append("</D:multistatus>")
+
+        yield "".join(chunk)
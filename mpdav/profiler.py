@@ -0,0 +1,123 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import StringIO
+import cProfile
+import collections
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+
+
+class Profile(object):
+    def __init__(self, record, reason, stats):
+        self.time = record.start
+        self.method = record.method
+        self.path = record.path
+        self.depth = record.depth
+        self.status = record.status
+        self.duration = record.duration
+        self.reason = reason  # "sampled" or "slow"
+        self.stats = stats  # as in pstats files
+
+    def format(self, top):
+        s = pstats.Stats(_Stats(self.stats), stream=StringIO.StringIO())
+        s.sort_stats("cumulative").print_stats(top)
+
+        return "%s %s depth=%s status=%s %.3fs (%s) at %s\n%s" % (
+            self.method, self.path.encode("utf-8"), self.depth, self.status, self.duration, self.reason,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.time)), s.stream.getvalue())
+
+
+class _Stats(object):
+    # what pstats.Stats needs from a profiler
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler(object):
+    # Instrumentation hook profiling requests with cProfile, including the
+    # production of streamed bodies. A fraction sample_rate of the
+    # requests is profiled and kept. With a threshold every request is
+    # profiled (which roughly doubles the CPU time per request), but only
+    # the ones slower than threshold seconds are kept. The last capacity
+    # profiles are kept in a ring buffer, report() formats them with the
+    # top functions by cumulative time, dump() writes them as pstats files.
+
+    def __init__(self, sample_rate=0.01, threshold=None, capacity=32, top=25):
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.top = top
+        self.lock = threading.Lock()
+        self.profiles = collections.deque(maxlen=capacity)
+
+    def request_started(self, record):
+        record.sampled = random.random() < self.sample_rate
+
+        if record.sampled or self.threshold is not None:
+            record.profile = cProfile.Profile()
+            record.profile.enable()
+
+    def request_finished(self, record):
+        profile = record.profile
+        if profile is None:
+            return
+
+        profile.disable()
+        record.profile = None
+
+        if record.sampled:
+            reason = "sampled"
+        elif record.duration >= self.threshold:
+            reason = "slow"
+        else:
+            return
+
+        profile.create_stats()
+
+        with self.lock:
+            self.profiles.append(Profile(record, reason, profile.stats))
+
+    def report(self):
+        with self.lock:
+            profiles = list(self.profiles)
+
+        return "\n".join(p.format(self.top) for p in reversed(profiles))
+
+    def dump(self, directory):
+        # one file per profile, for pstats, snakeviz and the like
+        with self.lock:
+            profiles = list(self.profiles)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        filenames = []
+        for i, p in enumerate(profiles):
+            filename = os.path.join(directory, "mpdav-%s-%02d-%s.prof" % (
+                time.strftime("%Y%m%d-%H%M%S", time.localtime(p.time)), i, p.method))
+            with open(filename, "wb") as f:
+                marshal.dump(p.stats, f)
+            filenames.append(filename)
+
+        return filenames
@@ -0,0 +1,286 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import stat
+
+import multi_status
+import status
+
+
+class Property(object):
+    # A live property. add(prop_stat, resource) adds the property to the
+    # given PropStat and returns False if the property is not defined for
+    # the resource. Properties with allprop=False are too expensive or not
+    # meant to be returned for allprop requests (e.g. the quota properties,
+    # RFC 4331 section 3), they still show up in propname responses.
+
+    def __init__(self, name, add, allprop=True):
+        self.name = name
+        self.add = add
+        self.allprop = allprop
+
+
+class Resource(object):
+    # everything known about a single resource while evaluating a plan,
+    # expensive inputs are fetched on first access only
+
+    def __init__(self, backend, plan, path, st):
+        self.backend = backend
+        self.plan = plan
+        self.path = path
+        self.st = st
+        self.is_dir = stat.S_ISDIR(st.st_mode)
+        self._validators = None
+
+    @property
+    def name(self):
+        return self.backend._build_displayname(self.path)
+
+    @property
+    def statvfs(self):
+        return self.plan.statvfs(self)
+
+    @property
+    def mimetype(self):
+        return self.backend._mimetype(self.path)
+
+    @property
+    def dead_properties(self):
+        return self.plan.dead_properties(self)
+
+    @property
+    def validators(self):
+        if self._validators is None:
+            self._validators = self.backend._get_validators(self.path, self.st)
+
+        return self._validators
+
+
+class Plan(object):
+    # The properties to evaluate for every resource of a request, compiled
+    # once per request by Registry.compile. Names that are not live
+    # properties are looked up in the dead properties, which the backend
+    # loads for the whole request at once through dead_loader. For allprop,
+    # properties a resource does not define are omitted unless requested
+    # by name (in <include>).
+
+    def __init__(self, properties, unknown=(), names_only=False, allprop=False, requested=()):
+        self.properties = properties
+        self.unknown = list(unknown)
+        self.names_only = names_only
+        self.allprop = allprop
+        self.requested = frozenset(requested)
+        self.key = (names_only, allprop, tuple(p.name for p in properties), tuple(self.unknown),
+                    tuple(sorted(self.requested)))
+        self.fs_stats = {}
+        self.dead_loader = None
+        self.dead = None
+
+    def dead_properties(self, resource):
+        if self.dead_loader is None:
+            return {}
+
+        if self.dead is None:
+            self.dead = self.dead_loader()
+
+        return self.dead.get(resource.backend._resource_key(resource.path), {})
+
+    def statvfs(self, resource):
+        # statvfs once per file system instead of once per resource
+        dev = resource.st.st_dev
+
+        if dev not in self.fs_stats:
+            self.fs_stats[dev] = resource.backend._statvfs(resource.path, resource.st)
+
+        return self.fs_stats[dev]
+
+    def evaluate(self, resource, response):
+        found = multi_status.PropStat(status.OK)
+        not_found = None
+
+        dead = {}
+        if self.unknown or self.allprop or self.names_only:
+            dead = resource.dead_properties
+
+        for property_ in self.properties:
+            if self.names_only:
+                found.add_empty(property_.name)
+                continue
+
+            try:
+                defined = property_.add(found, resource) is not False
+            except (OSError, IOError):
+                defined = False
+
+            if not defined:
+                if self.allprop and property_.name not in self.requested:
+                    continue
+
+                if not_found is None:
+                    not_found = multi_status.PropStat(status.NOT_FOUND)
+                not_found.add_empty(property_.name)
+
+        if self.names_only:
+            for name in dead:
+                found.add_empty(name)
+        elif self.allprop:
+            for name, value in dead.items():
+                if name not in self.unknown:
+                    found.add_xml(value)
+
+        for name in self.unknown:
+            if name in dead:
+                found.add_xml(dead[name])
+                continue
+
+            if not_found is None:
+                not_found = multi_status.PropStat(status.NOT_FOUND)
+            not_found.add_empty(name)
+
+        if len(found.prop) or not_found is None:
+            response.add(found)
+        if not_found is not None:
+            response.add(not_found)
+
+
+class Registry(object):
+    def __init__(self, properties=()):
+        self.properties = {}
+        self.order = []
+
+        for p in properties:
+            self.register(p)
+
+    def register(self, property_):
+        if property_.name not in self.properties:
+            self.order.append(property_.name)
+
+        self.properties[property_.name] = property_
+
+    def compile(self, names=None, allprop=False, propname=False):
+        # names are the properties of a <prop> element, for allprop they are
+        # the ones of an (optional) <include> element
+        if propname:
+            return Plan([self.properties[n] for n in self.order], names_only=True)
+
+        selected = []
+        unknown = []
+
+        if allprop:
+            selected = [self.properties[n] for n in self.order if self.properties[n].allprop]
+
+        for name in names or ():
+            p = self.properties.get(name)
+            if p is None:
+                unknown.append(name)
+            elif p not in selected:
+                selected.append(p)
+
+        return Plan(selected, unknown, allprop=allprop, requested=names or ())
+
+
+def _add_resourcetype(prop_stat, resource):
+    prop_stat.add_resourcetype(resource.is_dir)
+
+
+def _add_creationdate(prop_stat, resource):
+    import file_backend  # not at module level, file_backend imports this module
+
+    prop_stat.add_creationdate(file_backend.epoch2iso8601(resource.st.st_ctime))
+
+
+def _add_displayname(prop_stat, resource):
+    prop_stat.add_displayname(resource.name)
+
+
+def _add_getcontentlength(prop_stat, resource):
+    if resource.is_dir:
+        return False
+
+    prop_stat.add_getcontentlength(resource.st.st_size)
+
+
+def _add_getcontenttype(prop_stat, resource):
+    if resource.is_dir:
+        return False
+
+    prop_stat.add_getcontenttype(resource.mimetype)
+
+
+def _add_getetag(prop_stat, resource):
+    prop_stat.add_getetag(resource.validators[0])
+
+
+def _add_getlastmodified(prop_stat, resource):
+    prop_stat.add_getlastmodified(resource.validators[1])
+
+
+def _add_quota_available_bytes(prop_stat, resource):
+    fs_st = resource.statvfs
+    prop_stat.add_quota_available_bytes(fs_st.f_bavail * fs_st.f_frsize)
+
+
+def _add_quota_used_bytes(prop_stat, resource):
+    fs_st = resource.statvfs
+    prop_stat.add_quota_used_bytes((fs_st.f_blocks - fs_st.f_bavail) * fs_st.f_frsize)
+
+
+def _add_lockdiscovery(prop_stat, resource):
+    backend = resource.backend
+    prop_stat.add_lockdiscovery(backend.locks.covering(backend._resource_key(resource.path)), backend.base_path)
+
+
+def _add_supportedlock(prop_stat, resource):
+    prop_stat.add_supportedlock()
+
+
+def add_sync_token(prop_stat, resource):
+    # registered by FileBackend if it keeps a change journal
+    if not resource.is_dir:
+        return False
+
+    prop_stat.add_sync_token(resource.backend.journal.token())
+
+
+def add_checksum(prop_stat, resource):
+    # registered by FileBackend if it has a ChecksumStore, missing until the
+    # checksum was computed
+    if resource.is_dir:
+        return False
+
+    checksums = resource.backend.checksums
+    digest = checksums.get(resource.path, resource.st)
+    if digest is None:
+        return False
+
+    prop_stat.add_checksum("%s:%s" % (checksums.algorithm.upper(), digest))
+
+
+DEFAULT_PROPERTIES = [
+    Property("{DAV:}resourcetype", _add_resourcetype),
+    Property("{DAV:}creationdate", _add_creationdate),
+    Property("{DAV:}displayname", _add_displayname),
+    Property("{DAV:}getcontentlength", _add_getcontentlength),
+    Property("{DAV:}getcontenttype", _add_getcontenttype),
+    Property("{DAV:}getetag", _add_getetag),
+    Property("{DAV:}getlastmodified", _add_getlastmodified),
+    Property("{DAV:}quota-available-bytes", _add_quota_available_bytes, allprop=False),
+    Property("{DAV:}quota-used-bytes", _add_quota_used_bytes, allprop=False),
+    Property("{DAV:}lockdiscovery", _add_lockdiscovery),
+    Property("{DAV:}supportedlock", _add_supportedlock),
+]
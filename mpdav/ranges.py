@@ -0,0 +1,123 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import email.utils
+
+MAX_RANGES = 64  # more ranges than this are ignored and the whole file is sent
+
+
+def parse_range(value, size):
+    # Returns a list of (offset, length) tuples, an empty list if none of the
+    # ranges is satisfiable or None if the header has to be ignored (RFC 7233
+    # says a syntactically invalid Range header is to be ignored).
+    if not value:
+        return None
+
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+
+    result = []
+    specs = 0
+
+    for r in spec.split(","):
+        r = r.strip()
+        if not r:
+            continue
+
+        specs += 1
+
+        first, sep, last = r.partition("-")
+        if not sep:
+            return None
+
+        try:
+            if not first:
+                # suffix range, e.g. "-500" => the last 500 bytes
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix == 0 or size == 0:
+                    continue
+
+                start = max(size - suffix, 0)
+                end = size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else None
+                if start < 0 or (end is not None and end < start):
+                    return None
+                if start >= size:
+                    continue
+
+                end = size - 1 if end is None else min(end, size - 1)
+        except ValueError:
+            return None
+
+        result.append((start, end - start + 1))
+
+    if not specs or len(result) > MAX_RANGES:
+        return None
+
+    return result
+
+
+def content_range(offset, length, size):
+    return "bytes %d-%d/%d" % (offset, offset + length - 1, size)
+
+
+def parse_content_range(value):
+    # Parses the Content-Range of a request, "bytes first-last/total" or
+    # "bytes */total" (a query, first and last are None), total can be "*"
+    # (None) if not known yet. Returns None if invalid.
+    unit, _, spec = value.strip().partition(" ")
+    if unit.lower() != "bytes":
+        return None
+
+    byte_range, sep, total = spec.strip().partition("/")
+    if not sep:
+        return None
+
+    try:
+        total = None if total.strip() == "*" else int(total)
+
+        if byte_range.strip() == "*":
+            first = last = None
+        else:
+            first, sep, last = byte_range.partition("-")
+            if not sep:
+                return None
+
+            first = int(first)
+            last = int(last)
+            if first < 0 or last < first or (total is not None and last >= total):
+                return None
+    except ValueError:
+        return None
+
+    if total is not None and total < 0:
+        return None
+
+    return first, last, total
+
+
+def http_date2epoch(value):
+    t = email.utils.parsedate_tz(value)
+    if t is None:
+        return None
+
+    return email.utils.mktime_tz(t)
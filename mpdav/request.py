@@ -17,27 +17,181 @@
 
 from __future__ import print_function
 
+import re
 import sys
 import urllib
 import urlparse
 import xml.etree.ElementTree as etree
 
+import instrumentation
+import locks
+import multi_status
+import ranges
 import response
 import status
 
+CONDITIONAL_HEADERS = ("If-Match", "If-None-Match", "If-Modified-Since", "If-Unmodified-Since")
+
+IF_LIST = re.compile(r"\s*(?:<([^>]*)>\s*)?\(([^)]*)\)")
+IF_CONDITION = re.compile(r"\s*(Not\s*)?(?:<([^>]*)>|\[([^\]]*)\])")
+
+
+def parse_etags(value):
+    # splits an If-Match/If-None-Match header into a list of entity tags
+    return [e.strip() for e in value.split(",") if e.strip()]
+
+
+def strip_weak(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def parse_if(value):
+    # Splits an If header (RFC 4918 section 10.4) into a list of (resource,
+    # conditions) tuples, resource is None for untagged lists. conditions
+    # are (negated, state token, entity tag) tuples with either state token
+    # or entity tag None. Returns None if the header is malformed.
+    result = []
+    resource = None
+    value = value.strip()
+    pos = 0
+
+    while pos < len(value):
+        m = IF_LIST.match(value, pos)
+        if m is None:
+            return None
+
+        if m.group(1) is not None:
+            resource = m.group(1)
+
+        conditions = []
+        inner = m.group(2)
+        inner_pos = 0
+
+        while inner[inner_pos:].strip():
+            c = IF_CONDITION.match(inner, inner_pos)
+            if c is None:
+                return None
+
+            conditions.append((bool(c.group(1)), c.group(2), c.group(3)))
+            inner_pos = c.end()
+
+        if not conditions:
+            return None
+
+        result.append((resource, conditions))
+        pos = m.end()
+
+    return result
+
+
+class ChunkedBodyError(IOError):
+    # the chunked request body is malformed or ended prematurely
+    pass
+
+
+class ChunkedReader(object):
+    # file-like object decoding a request body sent with
+    # "Transfer-Encoding: chunked", for WSGI servers that do not do it
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.remaining = 0  # in the current chunk
+        self.done = False
+
+    def read(self, size=-1):
+        result = []
+
+        while not self.done and size != 0:
+            if not self.remaining:
+                line = self.stream.readline(1024)
+                if not line:
+                    raise ChunkedBodyError("chunked request body ended prematurely")
+
+                try:
+                    self.remaining = int(line.split(";", 1)[0].strip(), 16)
+                except ValueError:
+                    raise ChunkedBodyError("invalid chunk size %r" % line)
+
+                if self.remaining < 0:
+                    raise ChunkedBodyError("invalid chunk size %r" % line)
+
+                if not self.remaining:
+                    # skip trailer headers
+                    while self.stream.readline(65537) not in ("\r\n", "\n", ""):
+                        pass
+
+                    self.done = True
+                    break
+
+            buf = self.stream.read(self.remaining if size < 0 else min(size, self.remaining))
+            if not buf:
+                raise ChunkedBodyError("chunked request body ended prematurely")
+
+            result.append(buf)
+            self.remaining -= len(buf)
+            if size > 0:
+                size -= len(buf)
+
+            if not self.remaining:
+                self.stream.readline(3)  # CRLF at the end of the chunk
+
+        return "".join(result)
+
 
 class RequestXml(object):
     def __init__(self, xml):
-        self.root = etree.fromstring(xml)
+        with instrumentation.phase(instrumentation.PHASE_PARSE):
+            self.root = etree.fromstring(xml)
+
+    def xml(self, *args):
+        # the serialized element, e.g. to store it as is
+        element = self._walk(self.root, args)
+        if element is None:
+            return None
+
+        element.tail = None
+        return etree.tostring(element, encoding="utf-8").decode("utf-8")
 
     def find(self, *args):
-        return self._walk(self.root, args)
+        element = self._walk(self.root, args)
+        return [child.tag for child in element] if element is not None else None
+
+    def text(self, *args):
+        element = self._walk(self.root, args)
+        return (element.text or "").strip() if element is not None else None
+
+    def updates(self):
+        # Returns the instructions of a PROPPATCH body as list of (name,
+        # value) tuples in document order, value is the serialized property
+        # element to set or None to remove it. None if the body is invalid.
+        if self.root.tag != "{DAV:}propertyupdate":
+            return None
+
+        result = []
+
+        for instruction in self.root:
+            if instruction.tag not in ("{DAV:}set", "{DAV:}remove"):
+                continue
+
+            for prop in instruction:
+                if prop.tag != "{DAV:}prop":
+                    continue
+
+                for element in prop:
+                    value = None
+                    if instruction.tag == "{DAV:}set":
+                        element.tail = None
+                        value = etree.tostring(element, encoding="utf-8").decode("utf-8")
+
+                    result.append((element.tag, value))
+
+        return result
 
     def _walk(self, element, path):
         if element.tag == path[0]:
             path = path[1:]
             if not path:
-                return [child.tag for child in element]
+                return element
 
             for child in element:
                 r = self._walk(child, path)
@@ -48,14 +202,54 @@ class RequestXml(object):
 
 
 class WebDavRequestHandler(object):
-    def __init__(self, backend):
+    def __init__(self, backend, hooks=None):
         self.backend = backend
+        self.hooks = hooks or []  # e.g. instrumentation.Metrics and AccessLog
 
     def handle(self, method, host, path, headers, body):
+        if self.hooks:
+            return self._handle_instrumented(method, host, path, headers, body)
+
+        return self._dispatch(method, host, path, headers, body)
+
+    def _handle_instrumented(self, method, host, path, headers, body):
+        record = instrumentation.RequestRecord(method, path, headers)
+
+        # a malformed Content-Length is left for the method to reject
+        try:
+            record.bytes_in = int(headers.get("Content-Length"))
+        except (TypeError, ValueError):
+            if body is not None:
+                body = instrumentation.CountingReader(body, record)
+
+        instrumentation.begin(record, self.hooks)
+        try:
+            r = self._dispatch(method, host, path, headers, body)
+        finally:
+            instrumentation.end(record)
+
+        record.status = r.status[0]
+
+        # the request is complete once the body has been sent
+        if r.body:
+            r.body = instrumentation.wrap_body(r.body, record, self.hooks)
+        else:
+            instrumentation.finish(record, self.hooks)
+
+        return r
+
+    def _dispatch(self, method, host, path, headers, body):
         func = getattr(self, "do_" + method, None)
         if func:
             try:
-                return func(host, path, headers, body)
+                r = func(host, path, headers, body)
+
+                # multistatus documents and listings are compressed here,
+                # static files by the backend
+                if self.backend.compressor is not None:
+                    r = self.backend.compressor.encode(r, headers)
+
+                return r
             except:
                 import traceback
                 print(traceback.format_exc(), file=sys.stderr)
@@ -64,6 +258,119 @@ class WebDavRequestHandler(object):
         else:
             return response.Response(status.NOT_IMPLEMENTED)
 
+    def _check_preconditions(self, method, path, headers):
+        # Evaluates the conditional request headers in the order given by
+        # RFC 7232 section 6. Returns None if the request may proceed or the
+        # response to send instead.
+        if not any(h in headers for h in CONDITIONAL_HEADERS):
+            return None
+
+        validators = self.backend.validators(path)
+        etag, last_modified, mtime = validators if validators else (None, None, None)
+
+        if "If-Match" in headers:
+            etags = parse_etags(headers["If-Match"])
+            if etag is None or not ("*" in etags or (not etag.startswith("W/") and etag in etags)):
+                return response.Response(status.PRECONDITION_FAILED)
+        elif "If-Unmodified-Since" in headers and mtime is not None:
+            since = ranges.http_date2epoch(headers["If-Unmodified-Since"])
+            if since is not None and mtime > since:
+                return response.Response(status.PRECONDITION_FAILED)
+
+        if "If-None-Match" in headers:
+            etags = parse_etags(headers["If-None-Match"])
+            if etag is not None and ("*" in etags or strip_weak(etag) in [strip_weak(e) for e in etags]):
+                if method in ("get", "head"):
+                    return self._not_modified(etag, last_modified)
+
+                return response.Response(status.PRECONDITION_FAILED)
+        elif "If-Modified-Since" in headers and method in ("get", "head") and mtime is not None:
+            since = ranges.http_date2epoch(headers["If-Modified-Since"])
+            if since is not None and mtime <= since:
+                return self._not_modified(etag, last_modified)
+
+        return None
+
+    def _not_modified(self, etag, last_modified):
+        r = response.Response(status.NOT_MODIFIED, {"ETag": etag, "Last-Modified": last_modified})
+
+        # a 304 must not carry a Content-Length differing from the one of the
+        # 200 (RFC 7230 section 3.3.2), which a cache would merge into its copy
+        del r.headers["Content-Length"]
+
+        return r
+
+    def _check_if(self, path, headers):
+        # Evaluates the If header. Returns the response to send instead if
+        # it fails (or None) and the lock tokens submitted with it.
+        if "If" not in headers:
+            return None, ()
+
+        lists = parse_if(headers["If"])
+        if lists is None:
+            return response.Response(status.BAD_REQUEST), ()
+
+        tokens = set(token for _, conditions in lists for negated, token, _ in conditions
+                     if token and not negated)
+
+        # the header is true if any of its lists is, a list if all of its
+        # conditions are
+        for resource, conditions in lists:
+            resource_path = path
+            if resource is not None:
+                resource_path = self.backend.relative_path(urllib.unquote(urlparse.urlparse(resource).path)
+                                                           .decode("utf-8"))
+                if resource_path is None:
+                    continue
+
+            current_tokens = None
+            current_etag = None
+
+            for negated, token, etag in conditions:
+                if token is not None:
+                    if current_tokens is None:
+                        current_tokens = self.backend.lock_tokens(resource_path)
+                    matched = token in current_tokens
+                else:
+                    if current_etag is None:
+                        validators = self.backend.validators(resource_path)
+                        current_etag = validators[0] if validators else ""
+                    matched = etag == current_etag
+
+                if matched == negated:
+                    break
+            else:
+                return None, tokens
+
+        return response.Response(status.PRECONDITION_FAILED), ()
+
+    def _check_locks(self, path, headers, recursive=False, member=False, destination=None):
+        # Returns a response if the If header fails or path (or destination)
+        # is locked without the lock token being submitted, None otherwise.
+        failed, tokens = self._check_if(path, headers)
+        if failed:
+            return failed
+
+        locked = self.backend.check_locks(path, tokens, recursive, member)
+        if not locked and destination is not None:
+            locked = self.backend.check_locks(destination, tokens, True, True)
+
+        return locked
+
+    def _destination(self, host, headers):
+        # Returns the path of the Destination header relative to the backend
+        # and the response to send instead if it is not acceptable.
+        destination = headers.get("Destination")
+        if not destination:
+            return None, response.Response(status.BAD_REQUEST)
+
+        url = urlparse.urlparse(destination)
+
+        if url.netloc.lower() != host.lower():
+            return None, response.Response(status.BAD_GATEWAY)
+
+        return urllib.unquote(url.path).decode("utf-8"), None
+
     def do_options(self, host, path, headers, body):
         methods = []
 
@@ -78,13 +385,16 @@ class WebDavRequestHandler(object):
         # RFC says, we should default to "infinity" if Depth header not given
         # but RFC says also that we do not need to support "inifity" for
         # performance or security reasons. So we default to "1".
-        depth = int(headers.get("Depth", 1))
-
-        # TODO if content-length 0 and no body => assume allprop
+        depth = headers.get("Depth", "1").strip().lower()
+        if depth in ("0", "1"):
+            depth = int(depth)
+        elif depth != "infinity":
+            return response.Response(status.BAD_REQUEST)
 
-        content_length = int(headers.get("Content-Length", 0))
+        content_length = int(headers.get("Content-Length") or 0)
 
-        request_xml = RequestXml(body.read(content_length))
+        # no body means allprop
+        request_xml = RequestXml(body.read(content_length)) if content_length else None
 
         try:
             return self.backend.propfind(path, depth, request_xml)
@@ -92,44 +402,61 @@ class WebDavRequestHandler(object):
             return response.Response(status.NOT_FOUND)
 
     def do_head(self, host, path, headers, body):
-        return self.backend.head(path)
+        return self._check_preconditions("head", path, headers) or self.backend.head(path, headers)
 
     def do_get(self, host, path, headers, body):
-        return self.backend.get(path)
+        return self._check_preconditions("get", path, headers) or self.backend.get(path, headers=headers)
 
     def do_put(self, host, path, headers, body):
-        content_length = headers.get("Content-Length")
-        if content_length is not None:
-            if content_length:
-                content_length = int(content_length)
-            else:
-                content_length = 0  # gvfs/1.12.1 sends Content-Length header without value
-
-            return self.backend.put(path, content_length, body)
+        failed = self._check_preconditions("put", path, headers) or self._check_locks(path, headers, member=True)
+        if failed:
+            return failed
+
+        content_range = None
+        if "Content-Range" in headers:
+            content_range = ranges.parse_content_range(headers["Content-Range"])
+            if content_range is None:
+                return response.Response(status.BAD_REQUEST)
+
+        if "chunked" in headers.get("Transfer-Encoding", "").lower():
+            content_length = None
+        elif "Content-Length" in headers:
+            try:
+                # gvfs/1.12.1 sends Content-Length header without value
+                content_length = int(headers["Content-Length"] or 0)
+            except ValueError:
+                return response.Response(status.BAD_REQUEST)
         else:
             return response.Response(status.LENGTH_REQUIRED)
 
+        try:
+            if content_range is not None:
+                return self.backend.put_range(path, content_range, content_length, body)
+            return self.backend.put(path, content_length, body)
+        except ChunkedBodyError:
+            return response.Response(status.BAD_REQUEST)
+
     def do_mkcol(self, host, path, headers, body):
-        return self.backend.mkcol(path)
+        return self._check_locks(path, headers, member=True) or self.backend.mkcol(path)
 
     def do_delete(self, host, path, headers, body):
-        return self.backend.delete(path)
+        return (self._check_preconditions("delete", path, headers) or
+                self._check_locks(path, headers, recursive=True, member=True) or
+                self.backend.delete(path))
 
     def do_move(self, host, path, headers, body):
         overwrite = headers.get("Overwrite", "T")
         if overwrite not in ("T", "F"):
             return response.Response(status.BAD_REQUEST)
 
-        destination = headers.get("Destination")
-        if not destination:
-            return response.Response(status.BAD_REQUEST)
-
-        url = urlparse.urlparse(destination)
-
-        if url.netloc.lower() != host.lower():
-            return response.Response(status.BAD_GATEWAY)
+        dest_path, failed = self._destination(host, headers)
+        if failed:
+            return failed
 
-        dest_path = urllib.unquote(url.path).decode("utf-8")
+        failed = (self._check_preconditions("move", path, headers) or
+                  self._check_locks(path, headers, True, True, self.backend.relative_path(dest_path)))
+        if failed:
+            return failed
 
         return self.backend.move(path, dest_path, overwrite == "T")
 
@@ -138,18 +465,99 @@ class WebDavRequestHandler(object):
         if overwrite not in ("T", "F"):
             return response.Response(status.BAD_REQUEST)
 
-        destination = headers.get("Destination")
-        if not destination:
+        dest_path, failed = self._destination(host, headers)
+        if failed:
+            return failed
+
+        failed = self._check_preconditions("copy", path, headers)
+        if failed:
+            return failed
+
+        # only the destination has to be unlocked, the source is just read
+        failed, tokens = self._check_if(path, headers)
+        destination = self.backend.relative_path(dest_path)
+        if not failed and destination is not None:
+            failed = self.backend.check_locks(destination, tokens, True, True)
+
+        return failed or self.backend.copy(path, dest_path, overwrite == "T")
+
+    def do_lock(self, host, path, headers, body):
+        depth = headers.get("Depth", "infinity").strip().lower()
+        if depth not in ("0", "infinity"):
             return response.Response(status.BAD_REQUEST)
 
-        url = urlparse.urlparse(destination)
+        failed, tokens = self._check_if(path, headers)
+        if failed:
+            return failed
 
-        if url.netloc.lower() != host.lower():
-            return response.Response(status.BAD_GATEWAY)
+        content_length = int(headers.get("Content-Length") or 0)
+        if not content_length:
+            # refresh of an existing lock, RFC 4918 section 9.10.2
+            return self.backend.refresh_lock(path, tokens, headers.get("Timeout"))
 
-        dest_path = urllib.unquote(url.path).decode("utf-8")
+        request_xml = RequestXml(body.read(content_length))
+
+        scope = request_xml.find("{DAV:}lockinfo", "{DAV:}lockscope") or []
+        if "{DAV:}exclusive" in scope:
+            scope = locks.SCOPE_EXCLUSIVE
+        elif "{DAV:}shared" in scope:
+            scope = locks.SCOPE_SHARED
+        else:
+            return response.Response(status.BAD_REQUEST)
+
+        if "{DAV:}write" not in (request_xml.find("{DAV:}lockinfo", "{DAV:}locktype") or []):
+            return response.Response(status.BAD_REQUEST)
+
+        owner = request_xml.xml("{DAV:}lockinfo", "{DAV:}owner")
+
+        return self.backend.lock(path, scope, 0 if depth == "0" else depth, owner, headers.get("Timeout"), tokens)
+
+    def do_unlock(self, host, path, headers, body):
+        token = headers.get("Lock-Token", "").strip()
+        if not (token.startswith("<") and token.endswith(">")):
+            return response.Response(status.BAD_REQUEST)
+
+        return self.backend.unlock(path, token[1:-1])
+
+    def do_report(self, host, path, headers, body):
+        content_length = int(headers.get("Content-Length") or 0)
+        if not content_length:
+            return response.Response(status.BAD_REQUEST)
+
+        request_xml = RequestXml(body.read(content_length))
+
+        if request_xml.root.tag != "{DAV:}sync-collection":
+            return multi_status.Error(status.FORBIDDEN, "{DAV:}supported-report")
 
-        return self.backend.copy(path, dest_path, overwrite == "T")
+        # the depth is given by sync-level, RFC 6578 section 3.3
+        if headers.get("Depth", "0").strip() != "0":
+            return response.Response(status.BAD_REQUEST)
+
+        level = request_xml.text("{DAV:}sync-collection", "{DAV:}sync-level")
+        if level not in ("1", "infinite"):
+            return response.Response(status.BAD_REQUEST)
+
+        token = request_xml.text("{DAV:}sync-collection", "{DAV:}sync-token") or None
+
+        try:
+            return self.backend.sync_collection(path, token, level, request_xml)
+        except IOError:
+            return response.Response(status.NOT_FOUND)
 
-    def do_proppatch(self, path, headers, body):
-        return response.Response(status.NOT_IMPLEMENTED)
+    def do_proppatch(self, host, path, headers, body):
+        failed = self._check_preconditions("proppatch", path, headers) or self._check_locks(path, headers)
+        if failed:
+            return failed
+
+        content_length = int(headers.get("Content-Length") or 0)
+        if not content_length:
+            return response.Response(status.BAD_REQUEST)
+
+        operations = RequestXml(body.read(content_length)).updates()
+        if not operations:
+            return response.Response(status.BAD_REQUEST)
+
+        try:
+            return self.backend.proppatch(path, operations)
+        except IOError:
+            return response.Response(status.NOT_FOUND)
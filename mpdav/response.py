@@ -17,7 +17,7 @@
 
 
 class Response(object):
-    compliance_class = "1"
+    compliance_class = "1,2"
 
     def __init__(self, status, headers={}, body=None):
         self.status = status
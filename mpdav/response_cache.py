@@ -0,0 +1,102 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import hashlib
+import threading
+import time
+
+
+class CachedResponse(object):
+    def __init__(self, body, content_type, expires):
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self.expires = expires
+
+
+class ResponseCache(object):
+    # LRU cache for rendered collection listings and multistatus documents
+    # with a budget on the total size of the cached bodies. Keys have to
+    # contain everything the body depends on (see FileBackend), the TTL only
+    # covers changes FileBackend cannot know about.
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=30.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None or entry.expires < time.time():
+                if entry is not None:
+                    self.size -= len(entry.body)
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry  # most recently used
+            self.hits += 1
+
+            return entry
+
+    def peek(self, key):
+        # like get, but does not count as a hit or change the LRU order
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry.expires < time.time():
+                return None
+
+            return entry
+
+    def put(self, key, body, content_type):
+        entry = CachedResponse(body, content_type, time.time() + self.ttl)
+
+        if len(body) > self.max_bytes:
+            return entry
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+
+            self.entries[key] = entry
+            self.size += len(body)
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.evictions += 1
+
+        return entry
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self.entries),
+                    "bytes": self.size}
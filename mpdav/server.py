@@ -0,0 +1,710 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import errno
+import os
+import Queue
+import select
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+from wsgiref.util import FileWrapper
+
+from request import ChunkedReader
+
+MAX_DRAIN = 65536  # unread request body up to this size is skipped to keep the connection
+
+
+class InputReader(object):
+    # wsgi.input limited to the Content-Length of the request, sends
+    # "100 Continue" on first read if the client asked for it
+
+    def __init__(self, handler, stream, length):
+        self.handler = handler
+        self.stream = stream
+        self.remaining = length
+
+    def _continue(self):
+        if self.handler.expect_continue:
+            self.handler.expect_continue = False
+            self.handler.wfile.write("%s 100 Continue\r\n\r\n" % self.handler.protocol_version)
+
+    def read(self, size=-1):
+        self._continue()
+
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ""
+
+        buf = self.stream.read(size)
+        self.remaining -= len(buf)
+
+        return buf
+
+    def readline(self, size=-1):
+        self._continue()
+
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ""
+
+        buf = self.stream.readline(size)
+        self.remaining -= len(buf)
+
+        return buf
+
+    def readlines(self, hint=None):
+        return list(iter(self.readline, ""))
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def drain(self):
+        # Returns True if the rest of the body was skipped, so the next
+        # request on this connection can be read.
+        if self.remaining > MAX_DRAIN or self.handler.expect_continue:
+            return self.remaining == 0
+
+        while self.remaining > 0:
+            if not self.read(min(self.remaining, 8192)):
+                return False
+
+        return True
+
+
+class ChunkedInputReader(InputReader):
+    def __init__(self, handler, stream):
+        InputReader.__init__(self, handler, ChunkedReader(stream), 0)
+        self.read_bytes = 0
+
+    def read(self, size=-1):
+        self._continue()
+
+        buf = self.stream.read(size)
+        self.read_bytes += len(buf)
+
+        return buf
+
+    def readline(self, size=-1):
+        # good enough for WSGI applications, WebDAV bodies are read in blocks
+        return self.read(size)
+
+    def drain(self):
+        if self.stream.done:
+            return True
+        if self.handler.expect_continue:
+            return False
+
+        try:
+            while self.read_bytes <= MAX_DRAIN:
+                if not self.read(8192):
+                    return True
+        except (IOError, ValueError):
+            pass
+
+        return False
+
+
+class WSGIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # HTTP/1.1 request handler with persistent connections (and therefore
+    # pipelining, requests are read one after the other from the buffered
+    # connection) for WSGI applications.
+
+    protocol_version = "HTTP/1.1"
+    server_version = "mpdav"
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.idle = True
+        self.server.track(self, True)
+
+    def finish(self):
+        self.server.track(self, False)
+
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def handle(self):
+        # Like BaseHTTPRequestHandler.handle, but with a poller for idle
+        # connections the connection is handed back between requests, so
+        # waiting for the next request does not block a worker thread.
+        self.close_connection = 1
+        self.parked = False
+
+        self.handle_one_request()
+
+        while not self.close_connection:
+            if self.server.idle_connections is not None and not self._buffered():
+                self.parked = True
+                return
+
+            self.handle_one_request()
+
+    def _buffered(self):
+        # True if (pipelined) data was already read from the socket, it is
+        # lost when the connection is parked
+        buf = getattr(self.rfile, "_rbuf", None)
+
+        return buf is None or buf.tell() > 0
+
+    def handle_one_request(self):
+        self.idle = True
+
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, socket.error):
+            self.close_connection = 1
+            return
+
+        self.idle = False
+
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        elif len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        try:
+            self.run_wsgi()
+            self.wfile.flush()
+        except socket.error:
+            self.close_connection = 1
+
+        if self.server.stopping or self.server.saturated():
+            # free the worker for waiting connections
+            self.close_connection = 1
+
+    def get_environ(self):
+        if "?" in self.path:
+            path, query = self.path.split("?", 1)
+        else:
+            path, query = self.path, ""
+
+        env = {"wsgi.version": (1, 0),
+               "wsgi.url_scheme": "http",
+               "wsgi.errors": sys.stderr,
+               "wsgi.multithread": True,
+               "wsgi.multiprocess": self.server.multiprocess,
+               "wsgi.run_once": False,
+               "wsgi.file_wrapper": FileWrapper,
+               "SERVER_SOFTWARE": self.server_version,
+               "SERVER_NAME": self.server.server_name,
+               "SERVER_PORT": str(self.server.server_port),
+               "SERVER_PROTOCOL": self.request_version,
+               "REQUEST_METHOD": self.command,
+               "SCRIPT_NAME": "",
+               "PATH_INFO": urllib.unquote(path),
+               "QUERY_STRING": query,
+               "REMOTE_ADDR": self.client_address[0]}
+
+        if self.headers.typeheader is not None:
+            env["CONTENT_TYPE"] = self.headers.typeheader
+        if self.headers.getheader("content-length"):
+            env["CONTENT_LENGTH"] = self.headers.getheader("content-length")
+
+        for h in self.headers.headers:
+            k, v = h.split(":", 1)
+            k = k.replace("-", "_").upper()
+            v = v.strip()
+
+            if k in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                continue
+
+            k = "HTTP_" + k
+            env[k] = env[k] + "," + v if k in env else v
+
+        if "chunked" in self.headers.getheader("transfer-encoding", "").lower():
+            env["wsgi.input"] = ChunkedInputReader(self, self.rfile)
+            env["wsgi.input_terminated"] = True
+        else:
+            env["wsgi.input"] = InputReader(self, self.rfile, int(env.get("CONTENT_LENGTH") or 0))
+
+        return env
+
+    def run_wsgi(self):
+        environ = self.get_environ()
+        self.expect_continue = (self.request_version == "HTTP/1.1" and
+                                self.headers.getheader("expect", "").lower() == "100-continue")
+
+        self.response_status = None
+        self.response_headers = None
+        self.headers_sent = False
+        self.chunked = False
+
+        result = None
+        try:
+            result = self.server.app(environ, self.start_response)
+
+            if isinstance(result, FileWrapper) and self._sendfile(result):
+                pass
+            else:
+                for data in result:
+                    if data:
+                        self.write(data)
+
+            if not self.headers_sent:
+                self.write("")
+
+            if self.chunked:
+                self.wfile.write("0\r\n\r\n")
+        except socket.error:
+            raise
+        except:
+            self.log_error("%s", self._format_exc())
+
+            if self.headers_sent:
+                self.close_connection = 1
+            else:
+                self.response_status = "500 Internal Server Error"
+                self.response_headers = [("Content-Length", "0")]
+                self.write("")
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+        if not environ["wsgi.input"].drain():
+            self.close_connection = 1
+
+        self.log_request(self.response_status.split(" ", 1)[0])
+
+    def _format_exc(self):
+        import traceback
+        return traceback.format_exc()
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headers_sent:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        elif self.response_status is not None:
+            raise AssertionError("start_response() called twice")
+
+        self.response_status = status
+        self.response_headers = headers
+
+        return self.write
+
+    def _has_body(self):
+        code = int(self.response_status.split(" ", 1)[0])
+
+        return self.command != "HEAD" and code >= 200 and code not in (204, 304)
+
+    def _send_headers(self, first_data):
+        # headers go out together with the first piece of data
+        names = set(k.lower() for k, _ in self.response_headers)
+
+        lines = ["%s %s" % (self.protocol_version, self.response_status)]
+        lines.append("Server: %s" % self.version_string())
+        lines.append("Date: %s" % self.date_time_string())
+        lines.extend("%s: %s" % h for h in self.response_headers)
+
+        if self.close_connection == 0 and self.headers.getheader("connection", "").lower() == "close":
+            self.close_connection = 1
+
+        if "content-length" not in names and self._has_body():
+            if self.request_version == "HTTP/1.1":
+                lines.append("Transfer-Encoding: chunked")
+                self.chunked = True
+            else:
+                self.close_connection = 1
+
+        if self.server.stopping:
+            self.close_connection = 1
+
+        if self.close_connection:
+            lines.append("Connection: close")
+        elif self.request_version == "HTTP/1.0":
+            lines.append("Connection: keep-alive")
+
+        self.headers_sent = True
+        self.wfile.write("\r\n".join(lines) + "\r\n\r\n" + self._frame(first_data))
+
+    def _frame(self, data):
+        if not data or not self._has_body():
+            return ""
+        elif self.chunked:
+            return "%x\r\n%s\r\n" % (len(data), data)
+
+        return data
+
+    def write(self, data):
+        if self.response_status is None:
+            raise AssertionError("write() before start_response()")
+
+        if not self.headers_sent:
+            self._send_headers(data)
+        elif data and self._has_body():
+            self.wfile.write(self._frame(data))
+
+    def _sendfile(self, result):
+        # transmits a file with sendfile(2), needs a Content-Length
+        filelike = result.filelike
+        if not hasattr(filelike, "sendfile") or self.chunked:
+            return False
+        if "content-length" not in set(k.lower() for k, _ in self.response_headers):
+            return False
+
+        if not self.headers_sent:
+            self._send_headers("")
+        self.wfile.flush()
+
+        if not self._has_body():
+            return True
+
+        # the socket timeout has to be applied by sendfile, the descriptor
+        # is non-blocking because of it
+        return filelike.sendfile(self.connection.fileno(), self.connection.gettimeout())
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadPoolServer(SocketServer.TCPServer):
+    # Hands accepted connections to a fixed number of worker threads,
+    # connections beyond max_connections are answered with 503.
+
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, app, threads=16, max_connections=1024, keep_alive_timeout=15.0,
+                 reuse_port=False, multiprocess=False, quiet=False, handler_class=WSGIRequestHandler,
+                 bind_and_activate=True, park_idle=True):
+        self.app = app
+        self.threads = threads
+        self.max_connections = max_connections
+        self.keep_alive_timeout = keep_alive_timeout
+        self.reuse_port = reuse_port
+        self.multiprocess = multiprocess
+        self.quiet = quiet
+        self.stopping = False
+
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.handlers = set()
+        self.queue = Queue.Queue()
+
+        self.workers = []
+        self.park_idle = park_idle and IdleConnections.available()
+        self.idle_connections = None
+
+        SocketServer.TCPServer.__init__(self, address, handler_class, bind_and_activate)
+
+        host, port = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def serve_forever(self, poll_interval=0.5):
+        # workers are started here and not in __init__, so a server can be
+        # created before forking
+        if self.park_idle and self.idle_connections is None:
+            self.idle_connections = IdleConnections(self)
+
+        if not self.workers:
+            for i in range(self.threads):
+                t = threading.Thread(target=self._work, name="mpdav-worker-%d" % i)
+                t.daemon = True
+                t.start()
+                self.workers.append(t)
+
+        SocketServer.TCPServer.serve_forever(self, poll_interval)
+
+    def server_bind(self):
+        if self.reuse_port and hasattr(socket, "SO_REUSEPORT"):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        SocketServer.TCPServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            if self.connections >= self.max_connections or self.stopping:
+                full = True
+            else:
+                full = False
+                self.connections += 1
+
+        if full:
+            self._reject(request)
+        else:
+            self.queue.put((request, client_address))
+
+    def _reject(self, request):
+        try:
+            request.sendall("HTTP/1.1 503 Service Unavailable\r\n"
+                            "Content-Length: 0\r\nConnection: close\r\nRetry-After: 1\r\n\r\n")
+        except socket.error:
+            pass
+
+        self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            request, client_address = item
+            parked = False
+            try:
+                handler = self.RequestHandlerClass(request, client_address, self)
+                parked = handler.parked and not self.stopping
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                if parked:
+                    self.idle_connections.park(request, client_address)
+                else:
+                    self.close_connection(request)
+
+    def close_connection(self, request):
+        self.shutdown_request(request)
+
+        with self.lock:
+            self.connections -= 1
+
+    def saturated(self):
+        # connections are waiting for a free worker and cannot be parked
+        return self.idle_connections is None and not self.queue.empty()
+
+    def track(self, handler, active):
+        with self.lock:
+            if active:
+                self.handlers.add(handler)
+            else:
+                self.handlers.discard(handler)
+
+    def handle_error(self, request, client_address):
+        if sys.exc_info()[0] in (socket.error, socket.timeout):
+            return
+
+        SocketServer.TCPServer.handle_error(self, request, client_address)
+
+    def stop(self, timeout=30.0):
+        # Graceful shutdown: stop accepting, let running requests finish,
+        # close idle keep-alive connections and wait at most timeout
+        # seconds for the workers.
+        self.stopping = True
+        self.server_close()
+
+        if self.idle_connections is not None:
+            self.idle_connections.close_all()
+
+        with self.lock:
+            idle = [h for h in self.handlers if h.idle]
+
+        for handler in idle:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        for _ in self.workers:
+            self.queue.put(None)
+
+        deadline = time.time() + timeout
+        for t in self.workers:
+            t.join(max(deadline - time.time(), 0))
+
+
+class IdleConnections(object):
+    # Keep-alive connections between two requests wait here instead of in a
+    # worker thread. A single thread polls them and queues connections with
+    # a new request for the workers again, so the number of open
+    # connections is not limited by the number of threads.
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+        self.connections = {}  # fd => (request, client_address, deadline)
+
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.timeout = 0.5  # seconds
+        else:
+            self.poller = select.poll()
+            self.timeout = 500  # milliseconds
+
+        self.thread = threading.Thread(target=self._run, name="mpdav-idle")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def available():
+        return hasattr(select, "epoll") or hasattr(select, "poll")
+
+    def park(self, request, client_address):
+        fd = request.fileno()
+
+        with self.lock:
+            self.connections[fd] = (request, client_address, time.time() + self.server.keep_alive_timeout)
+            self.poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
+
+    def _take(self, fd):
+        with self.lock:
+            item = self.connections.pop(fd, None)
+            if item is not None:
+                self.poller.unregister(fd)
+
+        return item
+
+    def _run(self):
+        next_expiry = time.time() + 1
+
+        while not self.server.stopping:
+            try:
+                events = self.poller.poll(self.timeout)
+            except (IOError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, _ in events:
+                # readable, closed or broken: a worker will find out which
+                item = self._take(fd)
+                if item is not None:
+                    self.server.queue.put(item[:2])
+
+            now = time.time()
+            if now >= next_expiry:
+                with self.lock:
+                    expired = [fd for fd, item in self.connections.items() if item[2] < now]
+
+                for fd in expired:
+                    item = self._take(fd)
+                    if item is not None:
+                        self.server.close_connection(item[0])
+
+                next_expiry = now + 1
+
+    def close_all(self):
+        with self.lock:
+            fds = list(self.connections)
+
+        for fd in fds:
+            item = self._take(fd)
+            if item is not None:
+                self.server.close_connection(item[0])
+
+    def __len__(self):
+        return len(self.connections)
+
+
+def _run(server, graceful_timeout):
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever() returned, so not in here
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    server.serve_forever()
+    server.stop(graceful_timeout)
+
+
+def serve(app_factory, host="", port=8000, threads=16, processes=1, reuse_port=False,
+          max_connections=1024, keep_alive_timeout=15.0, graceful_timeout=30.0, quiet=False):
+    # Runs the WSGI application created by app_factory with a pool of
+    # threads in each of the given number of processes. The application is
+    # created in every process after forking, as threads (e.g. of a
+    # FileBackend) do not survive a fork. With reuse_port every process
+    # binds its own socket with SO_REUSEPORT and the kernel balances the
+    # connections, otherwise all processes accept from one shared socket.
+    multiprocess = processes > 1
+
+    def make_server(bind_and_activate=True):
+        return ThreadPoolServer((host, port), None, threads, max_connections, keep_alive_timeout,
+                                reuse_port, multiprocess, quiet, bind_and_activate=bind_and_activate)
+
+    if not multiprocess:
+        server = make_server()
+        server.app = app_factory()
+        _run(server, graceful_timeout)
+        return
+
+    if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+        reuse_port = False
+
+    shared = None if reuse_port else make_server()
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            return pid
+
+        try:
+            server = make_server() if reuse_port else shared
+            server.app = app_factory()
+            _run(server, graceful_timeout)
+        finally:
+            os._exit(0)
+
+    children = set(spawn() for _ in range(processes))
+    state = {"stopping": False}
+
+    def stop(signum, frame):
+        state["stopping"] = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                break
+            raise
+
+        children.discard(pid)
+
+        if not state["stopping"]:
+            print("worker process %d died, restarting" % pid, file=sys.stderr)
+            children.add(spawn())
+
+    if shared is not None:
+        shared.server_close()
@@ -18,15 +18,21 @@
 OK = (200, "OK")
 CREATED = (201, "Created")
 NO_CONTENT = (204, "No Content")
+PARTIAL_CONTENT = (206, "Partial Content")
 MULTI_STATUS = (207, "Multi-Status")
 
+NOT_MODIFIED = (304, "Not Modified")
+RESUME_INCOMPLETE = (308, "Resume Incomplete")  # resumable uploads, not in any RFC
+
 BAD_REQUEST = (400, "Bad Request")
 FORBIDDEN = (403, "Forbidden")
 NOT_FOUND = (404, "Not Found")
 NOT_ALLOWED = (405, "Method Not Allowed")
+NOT_ACCEPTABLE = (406, "Not Acceptable")
 CONFLICT = (409, "Conflict")
 LENGTH_REQUIRED = (411, "Length Required")
 PRECONDITION_FAILED = (412, "Precondition Failed")
+REQUESTED_RANGE_NOT_SATISFIABLE = (416, "Requested Range Not Satisfiable")
 LOCKED = (423, "Locked")
 FAILED_DEPENDENCY = (424, "Failed Dependency")
 
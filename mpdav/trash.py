@@ -0,0 +1,129 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+import Queue
+import errno
+import os
+import stat
+import threading
+import time
+import uuid
+
+TRASH_NAME = ".mpdav-trash"
+
+
+class Trash(object):
+    # Deleting a large tree takes as long as it takes to unlink every entry,
+    # so instead the tree is renamed into a trash directory on the same file
+    # system (atomic and constant time) and a pool of reaper threads removes
+    # it in the background, at most rate entries per second (0 means no
+    # limit). Whatever is left in the trash after a restart is removed as
+    # well.
+
+    def __init__(self, directory, workers=1, rate=0):
+        self.directory = directory
+        self.rate = rate
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.next_unlink = 0.0
+        self.pending = 0
+        self.removed = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+        for name in os.listdir(directory):
+            self._enqueue(os.path.join(directory, name))
+
+        for _ in range(max(workers, 1)):
+            t = threading.Thread(target=self._reap)
+            t.daemon = True
+            t.start()
+
+    def discard(self, path):
+        # Moves path into the trash. Returns False if that is not possible
+        # because path is on another device, the caller has to remove it
+        # itself then.
+        target = os.path.join(self.directory, uuid.uuid4().hex)
+
+        try:
+            os.rename(path, target)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                return False
+            raise
+
+        self._enqueue(target)
+
+        return True
+
+    def _enqueue(self, path):
+        with self.lock:
+            self.pending += 1
+
+        self.queue.put(path)
+
+    def _reap(self):
+        while True:
+            path = self.queue.get()
+
+            try:
+                self._remove(path)
+            except OSError:
+                pass  # picked up again on the next start
+
+            with self.lock:
+                self.pending -= 1
+
+    def _remove(self, path):
+        if not stat.S_ISDIR(os.lstat(path).st_mode):
+            self._unlink(os.remove, path)
+            return
+
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for f in filenames:
+                self._unlink(os.remove, os.path.join(dirpath, f))
+
+            for d in dirnames:
+                p = os.path.join(dirpath, d)
+                if os.path.islink(p):
+                    self._unlink(os.remove, p)  # os.walk does not descend into symlinks
+
+            self._unlink(os.rmdir, dirpath)
+
+    def _unlink(self, func, path):
+        if self.rate > 0:
+            with self.lock:
+                now = time.time()
+                wait = self.next_unlink - now
+                self.next_unlink = max(now, self.next_unlink) + 1.0 / self.rate
+
+            if wait > 0:
+                time.sleep(wait)
+
+        try:
+            func(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        with self.lock:
+            self.removed += 1
+
+    def stats(self):
+        with self.lock:
+            return {"pending": self.pending, "removed": self.removed}
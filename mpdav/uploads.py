@@ -0,0 +1,159 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+UPLOADS_NAME = ".mpdav-uploads"
+UPLOAD_TIMEOUT = 86400  # seconds a staged upload is kept without activity
+EXPIRE_INTERVAL = 60.0
+
+
+class Upload(object):
+    def __init__(self, key, filename, total, received):
+        self.key = key
+        self.filename = filename  # the data received so far
+        self.total = total  # None until a request tells
+        self.received = received
+
+
+class Uploads(object):
+    # Staged uploads of PUT requests with a Content-Range, one per target
+    # resource. Data is only accepted contiguously from offset 0, so the
+    # size of the staged file is what was received (including a partial
+    # request of a client that went away). Beside it is a small JSON file
+    # with the target and its total size, its mtime is the last activity.
+    # Uploads idle for longer than timeout are removed.
+
+    def __init__(self, directory, timeout=UPLOAD_TIMEOUT):
+        self.directory = directory
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = set()
+        self.next_expire = 0.0
+
+    def _paths(self, key):
+        name = os.path.join(self.directory, hashlib.md5(key.encode("utf-8")).hexdigest())
+
+        return name, name + ".json"
+
+    def status(self, key):
+        # (received, total) of the staged upload of key or None
+        filename, info = self._paths(key)
+
+        try:
+            with open(info, "rb") as f:
+                total = json.load(f)["total"]
+
+            return os.stat(filename).st_size, total
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def open(self, key, total):
+        # Returns the Upload of key, a new one if there is none. None if
+        # another request writes to it right now. Raises ValueError if total
+        # contradicts the one given before.
+        self.expire()
+
+        with self.lock:
+            if key in self.active:
+                return None
+            self.active.add(key)
+
+        try:
+            filename, info = self._paths(key)
+            current = self.status(key)
+
+            if current is not None and current[1] is not None:
+                if total is not None and total != current[1]:
+                    raise ValueError("total size changed")
+                total = current[1]
+
+            if current is None or current[1] != total:
+                if not os.path.isdir(self.directory):
+                    try:
+                        os.makedirs(self.directory, 0700)
+                    except OSError:
+                        if not os.path.isdir(self.directory):
+                            raise
+
+                # the info first, expire() only finds data with one
+                with open(info, "wb") as f:
+                    json.dump({"path": key, "total": total}, f)
+                os.close(os.open(filename, os.O_WRONLY | os.O_CREAT, 0600))
+
+            return Upload(key, filename, total, os.stat(filename).st_size)
+        except:
+            with self.lock:
+                self.active.discard(key)
+            raise
+
+    def close(self, upload):
+        # the request writing to upload is done
+        try:
+            os.utime(self._paths(upload.key)[1], None)
+        except OSError:
+            pass  # finished or discarded
+
+        with self.lock:
+            self.active.discard(upload.key)
+
+    def discard(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def expire(self, now=None):
+        now = now or time.time()
+
+        with self.lock:
+            if now < self.next_expire:
+                return
+            self.next_expire = now + min(EXPIRE_INTERVAL, self.timeout)
+
+            active = set(self._paths(key)[1] for key in self.active)
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+
+            info = os.path.join(self.directory, name)
+            if info in active:
+                continue
+
+            try:
+                if os.stat(info).st_mtime + self.timeout > now:
+                    continue
+            except OSError:
+                continue
+
+            for path in (info[:-len(".json")], info):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
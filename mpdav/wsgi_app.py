@@ -0,0 +1,89 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import urlparse
+
+import archive
+from headers_dict import HeadersDict
+from request import ChunkedReader, WebDavRequestHandler
+
+
+class DavWsgiApp(object):
+    # hooks see every request, see instrumentation. With metrics_path, GET
+    # requests of that path answer with the output of the hooks that can
+    # render themselves (instrumentation.Metrics) instead of a resource,
+    # the same for profile_path and the reports of profiler.Profiler.
+    # "?archive=tar" (or zip) in a GET of a collection asks for an archive
+    # like the corresponding Accept header, for links in browsers.
+
+    def __init__(self, backend, hooks=None, metrics_path=None, profile_path=None):
+        self.dav = WebDavRequestHandler(backend, hooks)
+        self.metrics_path = metrics_path
+        self.profile_path = profile_path
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"].lower()
+        host = environ["HTTP_HOST"]
+        path = environ["PATH_INFO"].decode("utf-8")
+
+        if path == self.metrics_path and method == "get":
+            return self._text(start_response, "".join(h.render() for h in self.dav.hooks if hasattr(h, "render")),
+                              "text/plain; version=0.0.4")
+        elif path == self.profile_path and method == "get":
+            return self._text(start_response, "\n".join(h.report() for h in self.dav.hooks if hasattr(h, "report")),
+                              "text/plain")
+        headers = self._build_headers(environ)
+        body = environ["wsgi.input"]
+
+        if method in ("get", "head") and environ.get("QUERY_STRING"):
+            media_type = archive.NAMES.get(urlparse.parse_qs(environ["QUERY_STRING"]).get("archive", [""])[-1])
+            if media_type is not None:
+                headers["Accept"] = media_type
+
+        if "chunked" in headers.get("Transfer-Encoding", "").lower() and not environ.get("wsgi.input_terminated"):
+            body = ChunkedReader(body)
+
+        response = self.dav.handle(method, host, path, headers, body)
+
+        start_response("%d %s" % (response.status),
+                       [(k, v) for k, v in response.headers.iteritems()])
+
+        if response.body:
+            if hasattr(response.body, "sendfile") and "wsgi.file_wrapper" in environ:
+                return environ["wsgi.file_wrapper"](response.body, response.body.block_size)
+
+            return response.body
+        else:
+            return []
+
+    def _text(self, start_response, body, content_type):
+        start_response("200 OK", [("Content-Type", content_type),
+                                  ("Content-Length", str(len(body)))])
+
+        return [body]
+
+    def _build_headers(self, environ):
+        result = HeadersDict()
+
+        for k, v in environ.iteritems():
+            if k.startswith("HTTP_"):
+                result[k[5:].replace("_", "-")] = v
+            elif k.startswith("CONTENT_"):
+                result[k.replace("_", "-")] = v
+
+        return result
@@ -0,0 +1,70 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import ctypes
+import ctypes.util
+import os
+import select
+import socket
+
+
+def _find_sendfile():
+    # os.sendfile (Python 3), pysendfile or sendfile(2) of the C library,
+    # all called as sendfile(out_fd, in_fd, offset, count)
+    if hasattr(os, "sendfile"):
+        return os.sendfile
+
+    try:
+        from sendfile import sendfile  # pysendfile
+        return sendfile
+    except ImportError:
+        pass
+
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+
+    try:
+        func = ctypes.CDLL(name, use_errno=True).sendfile64
+    except (OSError, AttributeError):
+        return None
+
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+
+    def sendfile(out_fd, in_fd, offset, count):
+        # with an offset, the file offset of in_fd is left unchanged
+        r = func(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), count)
+        if r < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        return r
+
+    return sendfile
+
+
+sendfile = _find_sendfile()
+
+
+def wait_writable(fd, timeout):
+    # Waits until the socket fd can take more data, like a send() on a
+    # socket with this timeout would (which makes the descriptor
+    # non-blocking). None waits forever.
+    if not select.select([], [fd], [], timeout)[1]:
+        raise socket.timeout("timed out")
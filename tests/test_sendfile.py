@@ -0,0 +1,91 @@
+# coding: utf-8
+#
+# This file is part of mpdav.
+#
+# mpdav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mpdav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import mpdav
+from mpdav import file_backend, zerocopy
+from mpdav.server import ThreadPoolServer
+
+
+class SendfileTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = os.urandom(3 * file_backend.FILE_BLOCK_SIZE + 17)
+        with open(os.path.join(self.root, "file"), "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_available(self):
+        self.assertIsNotNone(zerocopy.sendfile)
+
+    def test_file_iterator(self):
+        a, b = socket.socketpair()
+        b.settimeout(10)
+        body = file_backend.FileIterator(os.path.join(self.root, "file"), 5, len(self.data) - 10)
+
+        t = threading.Thread(target=body.sendfile, args=(a.fileno(), 10))
+        t.start()
+        received = []
+        while sum(len(r) for r in received) < len(self.data) - 10:
+            received.append(b.recv(65536))
+        t.join()
+
+        body.close()
+        a.close()
+        b.close()
+
+        self.assertEqual("".join(received), self.data[5:-5])
+        self.assertEqual(body.remaining, 0)
+
+    def test_server(self):
+        # the body must not be read in user space
+        def read(self, size=-1):
+            raise AssertionError("FileIterator.read() called")
+
+        server = ThreadPoolServer(("127.0.0.1", 0), mpdav.DavWsgiApp(mpdav.FileBackend(self.root)),
+                                  threads=2, quiet=True)
+        t = threading.Thread(target=server.serve_forever, args=(0.1, ))
+        t.start()
+
+        original = file_backend.FileIterator.read
+        file_backend.FileIterator.read = read
+        try:
+            connection = httplib.HTTPConnection("127.0.0.1", server.server_port, timeout=10)
+            connection.request("GET", "/file")
+            r = connection.getresponse()
+            self.assertEqual(r.status, 200)
+            self.assertEqual(r.read(), self.data)
+            connection.close()
+        finally:
+            file_backend.FileIterator.read = original
+            server.shutdown()
+            server.server_close()
+            t.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
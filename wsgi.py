@@ -16,43 +16,80 @@
 # You should have received a copy of the GNU General Public License
 # along with mpdav.  If not, see <http://www.gnu.org/licenses/>.
 
-from wsgiref.simple_server import make_server
-import mpdav
-
+import argparse
+import sys
 
-class DavWsgiApp(object):
-    def __init__(self):
-        self.dav = mpdav.WebDavRequestHandler(mpdav.FileBackend("data"))
-
-    def __call__(self, environ, start_response):
-        method = environ["REQUEST_METHOD"].lower()
-        host = environ["HTTP_HOST"]
-        path = environ["PATH_INFO"].decode("utf-8")
-        headers = self._build_headers(environ)
-        body = environ["wsgi.input"]
+import mpdav
+from mpdav.instrumentation import AccessLog, Metrics
+from mpdav.profiler import Profiler
+from mpdav.server import serve
 
-        response = self.dav.handle(method, host, path, headers, body)
 
-        start_response("%d %s" % (response.status),
-                       [(k, v) for k, v in response.headers.iteritems()])
+def main():
+    parser = argparse.ArgumentParser(description="WebDAV server")
+    parser.add_argument("--root", default="data", help="directory to serve (default: %(default)s)")
+    parser.add_argument("--host", default="", help="address to listen on (default: all)")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=16, help="worker threads per process (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes (default: %(default)s)")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="one listening socket per process with SO_REUSEPORT")
+    parser.add_argument("--max-connections", type=int, default=1024,
+                        help="connections per process, more get 503 (default: %(default)s)")
+    parser.add_argument("--keep-alive-timeout", type=float, default=15.0,
+                        help="seconds an idle connection is kept open (default: %(default)s)")
+    parser.add_argument("--graceful-timeout", type=float, default=30.0,
+                        help="seconds to wait for running requests on shutdown (default: %(default)s)")
+    parser.add_argument("--show-hidden", action="store_true", help="show files starting with a dot")
+    parser.add_argument("--compress", action="store_true",
+                        help="gzip/deflate Content-Encoding for listings, PROPFIND and text files")
+    parser.add_argument("--precompress", action="store_true",
+                        help="keep compressed copies of static files (implies --compress)")
+    parser.add_argument("--archives", action="store_true",
+                        help="GET of a collection with Accept: application/x-tar or application/zip "
+                             "(or ?archive=tar|zip) downloads the tree")
+    parser.add_argument("--content-cache", type=int, default=0, metavar="MB",
+                        help="keep frequently requested files in memory, up to MB megabytes (default: off)")
+    parser.add_argument("--checksums", type=int, default=0, metavar="WORKERS",
+                        help="strong ETags from SHA-256 checksums computed by WORKERS threads (default: off)")
+    parser.add_argument("--checksum-index",
+                        help="SQLite file for checksums on file systems without extended attributes")
+    parser.add_argument("--upload-timeout", type=float, default=86400,
+                        help="seconds a partial upload is kept without activity, 0 disables them "
+                             "(default: %(default)s)")
+    parser.add_argument("--quiet", action="store_true", help="do not log requests")
+    parser.add_argument("--metrics-path", help="serve Prometheus metrics at this path, e.g. /.metrics")
+    parser.add_argument("--access-log", help="write a JSON access log to this file, - for stderr")
+    parser.add_argument("--profile-path", help="serve profiles of sampled and slow requests at this path")
+    parser.add_argument("--profile-sample-rate", type=float, default=0.0,
+                        help="fraction of requests to profile (default: %(default)s)")
+    parser.add_argument("--profile-threshold", type=float,
+                        help="profile every request, keep the ones slower than this many seconds")
+    args = parser.parse_args()
 
-        if response.body:
-            return response.body
-        else:
-            return []
+    def app_factory():
+        hooks = []
+        if args.metrics_path:
+            hooks.append(Metrics())
+        if args.access_log:
+            hooks.append(AccessLog(sys.stderr if args.access_log == "-" else open(args.access_log, "a")))
+        if args.profile_path:
+            hooks.append(Profiler(args.profile_sample_rate, args.profile_threshold))
 
-    def _build_headers(self, environ):
-        result = mpdav.HeadersDict()
+        compressor = mpdav.Compressor() if args.compress or args.precompress else None
+        content_cache = mpdav.ContentCache(args.content_cache * 1024 * 1024) if args.content_cache else None
+        checksum_store = mpdav.ChecksumStore(args.checksums, index=args.checksum_index) if args.checksums else None
+        backend = mpdav.FileBackend(args.root, show_hidden=args.show_hidden, compressor=compressor,
+                                    precompress=args.precompress, upload_timeout=args.upload_timeout,
+                                    archives=args.archives, content_cache=content_cache,
+                                    checksum_store=checksum_store)
 
-        for k, v in environ.iteritems():
-            if k.startswith("HTTP_"):
-                result[k[5:].replace("_", "-")] = v
-            elif k.startswith("CONTENT_"):
-                result[k.replace("_", "-")] = v
+        return mpdav.DavWsgiApp(backend, hooks,
+                                args.metrics_path, args.profile_path)
 
-        return result
+    serve(app_factory, args.host, args.port, args.threads, args.processes, args.reuse_port,
+          args.max_connections, args.keep_alive_timeout, args.graceful_timeout, args.quiet)
 
 
 if __name__ == "__main__":
-    s = make_server('', 8000, DavWsgiApp())
-    s.serve_forever()
+    main()